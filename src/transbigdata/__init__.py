@@ -98,21 +98,39 @@ from transbigdata.coordinates import (
     wgs84tobd09,
     bd09towgs84,
     bd09mctobd09,
+    bd09tobd09mc,
     getdistance,
-    transform_shape
+    consecutive_distance,
+    transform_shape,
+    GCJ02Lattice
 )
 from transbigdata.grids import (
     area_to_grid,
     area_to_params,
     GPS_to_grid,
+    GPS_to_grid_chunks,
+    grid_count_chunks,
     grid_to_centre,
     grid_to_polygon,
+    grid_to_packed,
+    packed_to_grid,
     grid_to_area,
     grid_to_params,
+    grid_to_raster,
+    GPS_to_raster,
+    grid_neighbors,
+    params_to_parent,
+    grid_to_parent,
+    grid_to_children,
+    grid_pyramid,
     grid_params_optimize,
     geohash_encode,
     geohash_decode,
-    geohash_togrid
+    geohash_togrid,
+    geohash_neighbors,
+    geohash_cover,
+    GeohashIndex,
+    GridParams
 )
 from transbigdata.gisprocess import (
     ckdnearest,
@@ -149,6 +167,7 @@ from transbigdata.mobilephonedata import (
     )
 from transbigdata.traj import (
     traj_mapmatch,
+    traj_mapmatch_hmm,
     traj_clean_drift,
     traj_clean_redundant,
     traj_slice,
@@ -158,13 +177,19 @@ from transbigdata.traj import (
     traj_sparsify,
     traj_stay_move,
     traj_to_linestring,
-    traj_length
+    traj_length,
+    RoadNetworkIndex
 )
 
 from transbigdata.utils import (
     dumpjson
 )
 
+from transbigdata.backend import (
+    set_backend,
+    get_backend
+)
+
 from transbigdata.quality import (
     sample_duration,
     data_summary
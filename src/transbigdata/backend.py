@@ -0,0 +1,244 @@
+'''
+BSD 3-Clause License
+
+Copyright (c) 2021, Qing Yu
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import warnings
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+_backend = 'numpy'
+
+
+def set_backend(backend='numpy'):
+    '''
+    Set the backend of the numeric kernels of gridding, geohash encoding,
+    coordinates conversion and distance. With the numba backend, the
+    kernels run as compiled loops in parallel on all cores, without the
+    temporary arrays of each step. The results are identical to the numpy
+    backend.
+
+    Parameters
+    -------
+    backend : str
+        numpy or numba. If numba is not installed, the numpy backend is
+        used with a warning.
+    '''
+    global _backend
+    if backend not in ['numpy', 'numba']:
+        raise ValueError('Backend should be one of: numpy,numba')
+    if backend == 'numba':
+        try:
+            import numba  # noqa: F401
+        except ImportError:
+            warnings.warn(
+                'numba is not installed, the numpy backend is used. '
+                'Please install numba, run following code in cmd: '
+                'pip install numba')
+            backend = 'numpy'
+    _backend = backend
+
+
+def get_backend():
+    '''
+    Get the backend of the numeric kernels, numpy or numba
+    '''
+    return _backend
+
+
+def numba_kernels():
+    # The compiled kernels if the numba backend is used, otherwise None
+    if _backend == 'numba':
+        return _compile_kernels()
+    return None
+
+
+@lru_cache(maxsize=None)
+def _compile_kernels():
+    # Compile the kernels on first use. Each kernel follows the operation
+    # order of the numpy implementation so that the results are identical.
+    import math
+    from types import SimpleNamespace
+    from numba import njit, prange
+
+    from .coordinates import a, ee, pi
+
+    @njit(parallel=True, cache=True)
+    def affine_floor(lon, lat, c0, c1, m):
+        # floor((lon-c0)*m[t,0] + (lat-c1)*m[t,1]) for each row t of m
+        n = len(lon)
+        out = np.empty((m.shape[0], n), dtype=np.int64)
+        for i in prange(n):
+            dx = lon[i] - c0
+            dy = lat[i] - c1
+            for t in range(m.shape[0]):
+                out[t, i] = np.int64(np.floor(dx * m[t, 0] + dy * m[t, 1]))
+        return out
+
+    @njit(parallel=True, cache=True)
+    def hexa_assign(lon, lat, c0, c1, m, table):
+        # Triangle indexes, snapped onto the lattice and moved to the
+        # center of the hexagon
+        n = len(lon)
+        out = np.empty((3, n), dtype=np.int64)
+        for i in prange(n):
+            dx = lon[i] - c0
+            dy = lat[i] - c1
+            if not (math.isfinite(dx) and math.isfinite(dy)):
+                # Missing coordinates keep the minimum int64 index
+                out[0, i] = out[1, i] = out[2, i] = -(1 << 63)
+                continue
+            l1 = np.int64(np.floor(dx * m[0, 0] + dy * m[0, 1]))
+            l2 = np.int64(np.floor(dx * m[1, 0] + dy * m[1, 1]))
+            l3 = np.int64(np.floor(dx * m[2, 0] + dy * m[2, 1]))
+            flag = l1 - l2 + l3
+            if flag > 0:
+                l3 -= 1
+            elif flag < -1:
+                l3 += 1
+            row = (l1 % 3) * 9 + (l2 % 3) * 3 + (l3 % 3)
+            out[0, i] = l1 + table[row, 0]
+            out[1, i] = l2 + table[row, 1]
+            out[2, i] = l3 + table[row, 2]
+        return out
+
+    @njit(cache=True)
+    def bisect_index(x, lo, hi, nbits):
+        n = 1 << nbits
+        w = (hi - lo) / n
+        if math.isnan(x):
+            return np.int64(0)
+        kf = np.ceil((x - lo) / w) - 1
+        k = np.int64(min(max(kf, 0.0), n - 1.0))
+        if (k > 0) and (x <= lo + k * w):
+            k -= 1
+        if (k < n - 1) and (x > lo + (k + 1) * w):
+            k += 1
+        return k
+
+    @njit(cache=True)
+    def spread_bits(v):
+        v = np.uint64(v) & np.uint64(0x00000000FFFFFFFF)
+        v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+        v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+        v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+        v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+        return v
+
+    @njit(parallel=True, cache=True)
+    def geohash_encode(lon, lat, nbits):
+        n = len(lon)
+        out = np.empty(n, dtype=np.int64)
+        lon_bits = (nbits + 1) // 2
+        lat_bits = nbits // 2
+        for i in prange(n):
+            lon_bit = spread_bits(bisect_index(lon[i], -180.0, 180.0,
+                                               lon_bits))
+            lat_bit = spread_bits(bisect_index(lat[i], -90.0, 90.0,
+                                               lat_bits))
+            if nbits % 2:
+                code = lon_bit | (lat_bit << np.uint64(1))
+            else:
+                code = (lon_bit << np.uint64(1)) | lat_bit
+            out[i] = np.int64(code)
+        return out
+
+    @njit(parallel=True, cache=True)
+    def haversine(lon1, lat1, lon2, lat2):
+        # The haversine term a, arcsin is left to numpy
+        n = len(lon1)
+        out = np.empty(n)
+        for i in prange(n):
+            rlon1 = lon1[i] * pi / 180
+            rlat1 = lat1[i] * pi / 180
+            rlon2 = lon2[i] * pi / 180
+            rlat2 = lat2[i] * pi / 180
+            s1 = math.sin((rlat2 - rlat1) / 2)
+            s2 = math.sin((rlon2 - rlon1) / 2)
+            out[i] = s1 * s1 + math.cos(rlat1) * math.cos(rlat2) * (s2 * s2)
+        return out
+
+    @njit(parallel=True, cache=True)
+    def gcj02_offset(lng, lat):
+        # The GCJ02 coordinates of the WGS84 coordinates
+        n = len(lng)
+        mglng = np.empty(n)
+        mglat = np.empty(n)
+        for i in prange(n):
+            x = lng[i] - 105.0
+            y = lat[i] - 35.0
+            dlat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + \
+                0.1 * x * y + 0.2 * math.sqrt(abs(x))
+            dlat += (20.0 * math.sin(6.0 * x * pi) + 20.0 *
+                     math.sin(2.0 * x * pi)) * 2.0 / 3.0
+            dlat += (20.0 * math.sin(y * pi) + 40.0 *
+                     math.sin(y / 3.0 * pi)) * 2.0 / 3.0
+            dlat += (160.0 * math.sin(y / 12.0 * pi) + 320 *
+                     math.sin(y * pi / 30.0)) * 2.0 / 3.0
+            dlng = 300.0 + x + 2.0 * y + 0.1 * x * x + \
+                0.1 * x * y + 0.1 * math.sqrt(abs(x))
+            dlng += (20.0 * math.sin(6.0 * x * pi) + 20.0 *
+                     math.sin(2.0 * x * pi)) * 2.0 / 3.0
+            dlng += (20.0 * math.sin(x * pi) + 40.0 *
+                     math.sin(x / 3.0 * pi)) * 2.0 / 3.0
+            dlng += (150.0 * math.sin(x / 12.0 * pi) + 300.0 *
+                     math.sin(x / 30.0 * pi)) * 2.0 / 3.0
+            radlat = lat[i] / 180.0 * pi
+            magic = math.sin(radlat)
+            magic = 1 - ee * magic * magic
+            sqrtmagic = math.sqrt(magic)
+            dlat = (dlat * 180.0) / ((a * (1 - ee)) /
+                                     (magic * sqrtmagic) * pi)
+            dlng = (dlng * 180.0) / (a / sqrtmagic * math.cos(radlat) * pi)
+            mglat[i] = lat[i] + dlat
+            mglng[i] = lng[i] + dlng
+        return mglng, mglat
+
+    return SimpleNamespace(affine_floor=affine_floor,
+                           hexa_assign=hexa_assign,
+                           geohash_encode=geohash_encode,
+                           haversine=haversine,
+                           gcj02_offset=gcj02_offset)
+
+
+def float_arrays(*arrays):
+    # Contiguous 1-D float64 arrays of the same length for the kernels
+    arrays = np.broadcast_arrays(*[np.atleast_1d(
+        np.asarray(x, dtype=np.float64)) for x in arrays])
+    return [np.ascontiguousarray(x) for x in arrays]
+
+
+def wrap_like(values, like):
+    # Keep the index of the input Series on the kernel output
+    if isinstance(like, pd.Series):
+        return pd.Series(values, index=like.index, copy=False)
+    return values
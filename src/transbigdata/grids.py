@@ -32,15 +32,20 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Polygon
+import shapely
+from shapely.geometry import box
 import math
+import hashlib
 import numpy as np
+from collections.abc import Mapping
+from functools import lru_cache
 from .coordinates import getdistance
-from .gisprocess import merge_polygon
+from .backend import numba_kernels, float_arrays
 import warnings
 
 
-def area_to_grid(location, accuracy=500, method='rect', params='auto'):
+def area_to_grid(location, accuracy=500, method='rect', params='auto',
+                 tilesize=1000000):
     '''
     Generate the rectangular grids in the bounds or shape
 
@@ -55,18 +60,26 @@ def area_to_grid(location, accuracy=500, method='rect', params='auto'):
         Grid size (meter)
     method : str
         rect, tri or hexa
-    params : list or dict
+    params : list, dict or GridParams
         Gridding parameters. 
         See https://transbigdata.readthedocs.io/en/latest/grids.html 
         for detail information about gridding parameters.
         When Gridding parameters is given, accuracy will not be used.
+    tilesize : int
+        The maximum number of candidate grids generated at a time. The grids
+        are enumerated tile by tile and clipped to the shape before the next
+        tile is generated, which bounds the memory for fine grids over large
+        areas.
 
     Returns
     -------
     grid : GeoDataFrame
         Grid GeoDataFrame,
         LONCOL and LATCOL are the index of grids,
-        HBLON and HBLAT are the center of the grids
+        HBLON and HBLAT are the center of the grids.
+        The grids overlapping the shape, or the bounds expanded by one
+        grid, with a positive area. The grids only touching them are not
+        included.
     params : list or dict
         Gridding parameters. 
         See https://transbigdata.readthedocs.io/en/latest/grids.html 
@@ -78,7 +91,7 @@ def area_to_grid(location, accuracy=500, method='rect', params='auto'):
         bounds = location
     elif type(location) == gpd.geodataframe.GeoDataFrame:
         shape = location
-        bounds = shape.unary_union.bounds
+        bounds = tuple(shape.total_bounds)
     else:
         raise Exception(  # pragma: no cover
             'Location should be either bounds(List) or shape(GeoDataFrame)')
@@ -107,56 +120,138 @@ def area_to_grid(location, accuracy=500, method='rect', params='auto'):
         params = convertparams(params)
         method = params['method']
     if method == 'rect':
-        tmppoints = pd.DataFrame(np.array(
-            np.meshgrid(
-                np.arange(bounds[0] - deltaLon,
-                          bounds[2] + deltaLon,
-                          deltaLon/3),
-                np.arange(bounds[1]-deltaLat,
-                          bounds[3]+deltaLat,
-                          deltaLat/3))
-        ).reshape(2, -1).T,
-            columns=['lon', 'lat'])
-        tmppoints['LONCOL'], tmppoints['LATCOL'] = GPS_to_grid(
-            tmppoints['lon'], tmppoints['lat'], params)
-        tmppoints = tmppoints[['LONCOL', 'LATCOL']].drop_duplicates()
-        tmppoints['geometry'] = grid_to_polygon(
-            [tmppoints['LONCOL'], tmppoints['LATCOL']], params)
-        tmppoints = gpd.GeoDataFrame(tmppoints)
-    if (method == 'tri') | (method == 'hexa'):
-        tmppoints = pd.DataFrame(
-            np.array(
-                np.meshgrid(
-                    np.arange(bounds[0]-deltaLon,
-                              bounds[2] + deltaLon,
-                              deltaLon/3),
-                    np.arange(bounds[1]+deltaLat,
-                              bounds[3]-deltaLat,
-                              deltaLat/3))
-            ).reshape(2, -1).T, columns=['lon', 'lat'])
-        tmppoints['loncol_1'],\
-            tmppoints['loncol_2'],\
-            tmppoints['loncol_3'] = GPS_to_grid(
-            tmppoints['lon'], tmppoints['lat'], params)
-        tmppoints = tmppoints[['loncol_1',
-                               'loncol_2', 'loncol_3']].drop_duplicates()
-        tmppoints['geometry'] = grid_to_polygon(
-            [tmppoints['loncol_1'],
-             tmppoints['loncol_2'],
-             tmppoints['loncol_3']], params)
-        tmppoints = gpd.GeoDataFrame(tmppoints)
-    data = tmppoints
-    params['gridsize'] = accuracy
+        columns = ['LONCOL', 'LATCOL']
+    else:
+        columns = ['loncol_1', 'loncol_2', 'loncol_3']
+    # The grids covering the bounds expanded by one grid are enumerated
+    expanded = box(lon1 - params['deltalon'], lat1 - params['deltalat'],
+                   lon2 + params['deltalon'], lat2 + params['deltalat'])
+    need_clip = (method != 'rect') | (params['theta'] % 90 != 0)
+    tiles = []
+    for gridid in area_to_gridid(expanded.bounds, params, tilesize):
+        geometry = grid_to_polygon(gridid, params)
+        if type(shape) == gpd.geodataframe.GeoDataFrame:
+            # Clip to the shape through its spatial index, only the grids
+            # overlapping the shape with a positive area are kept
+            idx, shape_idx = shape.sindex.query(
+                geometry, predicate='intersects')
+            flag = grid_overlaps(geometry[idx],
+                                 shape.geometry.values[shape_idx])
+            keep = np.unique(idx[flag])
+        elif need_clip:
+            # The index range of rotated grids is wider than the bounds
+            keep = np.flatnonzero(grid_overlaps(geometry, expanded))
+        else:
+            # The index range of rect grids is exactly the grids
+            # overlapping the bounds, see area_to_gridid
+            keep = slice(None)
+        tile = pd.DataFrame(
+            {col: np.asarray(value)[keep]
+             for col, value in zip(columns, gridid)})
+        tile['geometry'] = geometry[keep]
+        tiles.append(tile)
+    data = pd.concat(tiles, ignore_index=True)
+    if isinstance(params, GridParams):
+        params = params.replace(gridsize=accuracy)
+    else:
+        params['gridsize'] = accuracy
     if type(shape) != gpd.geodataframe.GeoDataFrame:
         grid = gpd.GeoDataFrame(data)
         return grid, params
     else:
-        data.crs = shape.crs
-        data = data[data.intersects(shape.unary_union)]
-        grid = gpd.GeoDataFrame(data)
+        grid = gpd.GeoDataFrame(data, crs=shape.crs)
         return grid, params
 
 
+def grid_overlaps(geometry, region, rtol=1e-9):
+    # Whether each grid overlaps the region with a positive area. The
+    # tolerance, relative to the grid area, absorbs the slivers that
+    # floating point error leaves where a grid only touches the region.
+    # The grids inside the region are kept without the intersection.
+    inside = shapely.contains_properly(region, geometry)
+    flag = inside.copy()
+    edge = ~inside
+    flag[edge] = shapely.area(shapely.intersection(
+        geometry[edge], np.broadcast_to(region, inside.shape)[edge])) > \
+        rtol * shapely.area(geometry[edge])
+    return flag
+
+
+def area_to_gridid(bounds, params, tilesize=1000000):
+    '''
+    Enumerate the ID of the grids covering the bounds directly from the
+    index range of the grids, without sampling points in the bounds.
+    The grid IDs are generated in tiles of rows.
+
+    Parameters
+    -------
+    bounds : List
+        [lon1, lat1, lon2, lat2]
+    params : list, dict or GridParams
+        Gridding parameters.
+        See https://transbigdata.readthedocs.io/en/latest/grids.html
+        for detail information about gridding parameters.
+    tilesize : int
+        The maximum number of candidate grids in each tile
+
+    Returns
+    -------
+    gridid : generator
+        Generate the grid ID of each tile, [LONCOL,LATCOL] for rect grids
+        and [loncol_1,loncol_2,loncol_3] for triangle and hexagon grids.
+        For rotated rect grids and triangle and hexagon grids, the grids
+        near the corners of the index range may not intersect the bounds.
+    '''
+    params = GridParams.from_params(params)
+    lon1, lat1, lon2, lat2 = bounds
+    corners = np.array([[lon1, lat1], [lon2, lat1],
+                        [lon2, lat2], [lon1, lat2]])
+    if params.method == 'rect':
+        # The grid [i, i+1) overlaps [u_min, u_max) when
+        # floor(u_min) <= i < ceil(u_max). The bounds on the grid lines
+        # may be off by floating point error, which is not counted as an
+        # overlap.
+        u = np.dot(corners - params.corner, params.R_inv)
+        eps = 1e-9
+        cols = np.arange(np.floor(u[:, 0].min() + eps),
+                         np.ceil(u[:, 0].max() - eps), dtype=np.int64)
+        rows = np.arange(np.floor(u[:, 1].min() + eps),
+                         np.ceil(u[:, 1].max() - eps), dtype=np.int64)
+    else:
+        u = np.array([np.dot(corners - params.origin, R_inv)[:, 0]
+                      for R_inv in params.R_inv_axes])
+        if params.method == 'tri':
+            # Triangle (a, b, c) lies in [a, a+1)x[b, b+1)x[c, c+1) with
+            # c = b-a or b-a-1
+            u_min = np.floor(u.min(axis=1)).astype(np.int64)
+            u_max = np.floor(u.max(axis=1)).astype(np.int64)
+        else:
+            # Hexagon centered on vertex (i, j, k) lies in
+            # (i-1, i+1)x(j-1, j+1)x(k-1, k+1) with k = j-i
+            u_min = np.floor(u.min(axis=1)).astype(np.int64)
+            u_max = np.ceil(u.max(axis=1)).astype(np.int64)
+        cols = np.arange(u_min[0], u_max[0] + 1)
+        rows = np.arange(u_min[1], u_max[1] + 1)
+    nrows = max(1, tilesize // max(1, len(cols)))
+    for start in range(0, len(rows), nrows):
+        col, row = np.meshgrid(cols, rows[start:start + nrows])
+        col = col.ravel()
+        row = row.ravel()
+        if params.method == 'rect':
+            yield [col, row]
+            continue
+        if params.method == 'tri':
+            col = np.repeat(col, 2)
+            row = np.repeat(row, 2)
+            third = row - col - np.tile([0, 1], len(col) // 2)
+            flag = (third >= u_min[2]) & (third <= u_max[2])
+        else:
+            third = row - col
+            flag = (third >= u_min[2]) & (third <= u_max[2]) & \
+                is_hexa_center(col, row, third)
+        yield [col[flag], row[flag], third[flag]]
+
+
 def area_to_params(location, accuracy=500, method='rect'):
     '''
     Generate gridding params
@@ -208,7 +303,7 @@ def area_to_params(location, accuracy=500, method='rect'):
     return params
 
 
-def GPS_to_grid(lon, lat, params):
+def GPS_to_grid(lon, lat, params, packed=False):
     '''
     Match the GPS data to the grids. The input is the columns of
     longitude, latitude, and the grids parameter. The output is the grid ID.
@@ -219,10 +314,13 @@ def GPS_to_grid(lon, lat, params):
         The column of longitude
     lat : Series
         The column of latitude
-    params : list or dict
+    params : list, dict or GridParams
         Gridding parameters. 
         See https://transbigdata.readthedocs.io/en/latest/grids.html 
         for detail information about gridding parameters.
+    packed : bool
+        If True, return the grid ID as a single int64 key, see
+        `grid_to_packed`.
 
     Returns
     -------
@@ -235,18 +333,246 @@ def GPS_to_grid(lon, lat, params):
     [loncol_1,loncol_2,loncol_3] : list
         The index of the grid latitude. The two columns LONCOL and
         LATCOL together can specify a grid.
+
+    `packed=True`
+    grid : ndarray
+        The int64 key of the grid
     '''
-    params = convertparams(params)
+    params = GridParams.from_params(params)
     method = params['method']
     if method == 'rect':
         loncol, latcol = GPS_to_grids_rect(lon, lat, params)
-        return [loncol, latcol]
+        gridid = [loncol, latcol]
     if method == 'tri':
         loncol_1, loncol_2, loncol_3 = GPS_to_grids_tri(lon, lat, params)
-        return [loncol_1, loncol_2, loncol_3]
+        gridid = [loncol_1, loncol_2, loncol_3]
     if method == 'hexa':
         loncol_1, loncol_2, loncol_3 = GPS_to_grids_hexa(lon, lat, params)
-        return [loncol_1, loncol_2, loncol_3]
+        gridid = [loncol_1, loncol_2, loncol_3]
+    if packed:
+        return grid_to_packed(gridid, params)
+    return gridid
+
+
+def GPS_to_grid_chunks(chunks, params, col=['lon', 'lat'], packed=False):
+    '''
+    Match the GPS data to the grids chunk by chunk, for the data that does
+    not fit in memory, e.g. read by `pd.read_csv(..., chunksize=...)`.
+
+    Parameters
+    -------
+    chunks : iterable
+        The chunks of the GPS data, each chunk is either a DataFrame or a
+        tuple of the longitude and latitude arrays. The coordinates of each
+        chunk are converted to float64 arrays for the gridding, so float32
+        chunks are copied, one chunk at a time.
+    params : list, dict or GridParams
+        Gridding parameters.
+        See https://transbigdata.readthedocs.io/en/latest/grids.html
+        for detail information about gridding parameters.
+    col : List
+        Column names of longitude and latitude in the DataFrame chunks
+    packed : bool
+        If True, the grid ID is given as a single int64 key, see
+        `grid_to_packed`.
+
+    Returns
+    -------
+    chunks : generator
+        For DataFrame chunks, the same DataFrame with the grid ID columns
+        added (LONCOL and LATCOL for rect grids, loncol_1, loncol_2 and
+        loncol_3 for triangle and hexagon grids, or grid if packed).
+        For array chunks, the grid ID as returned by `GPS_to_grid`.
+    '''
+    params = GridParams.from_params(params)
+    [lon, lat] = col
+    if packed:
+        columns = ['grid']
+    elif params.method == 'rect':
+        columns = ['LONCOL', 'LATCOL']
+    else:
+        columns = ['loncol_1', 'loncol_2', 'loncol_3']
+    for chunk in chunks:
+        if isinstance(chunk, pd.DataFrame):
+            gridid = GPS_to_grid(chunk[lon].values, chunk[lat].values,
+                                 params, packed=packed)
+            if packed:
+                gridid = [gridid]
+            for column, value in zip(columns, gridid):
+                chunk[column] = np.atleast_1d(value)
+            yield chunk
+        else:
+            chunk_lon, chunk_lat = chunk
+            yield GPS_to_grid(chunk_lon, chunk_lat, params, packed=packed)
+
+
+def grid_count_chunks(chunks, params, col=['lon', 'lat'], count=None):
+    '''
+    Count the GPS data in each grid chunk by chunk. The counts of each chunk
+    are merged into the aggregate before the next chunk is read, so the
+    memory only depends on the number of grids.
+
+    Parameters
+    -------
+    chunks : iterable
+        The chunks of the GPS data, each chunk is either a DataFrame or a
+        tuple of the longitude and latitude arrays
+    params : list, dict or GridParams
+        Gridding parameters.
+        See https://transbigdata.readthedocs.io/en/latest/grids.html
+        for detail information about gridding parameters.
+    col : List
+        Column names of longitude and latitude in the DataFrame chunks
+    count : str
+        The column of the weight of each record in the DataFrame chunks,
+        if None, the records are counted
+
+    Returns
+    -------
+    data : DataFrame
+        The grid ID (LONCOL and LATCOL for rect grids, loncol_1, loncol_2
+        and loncol_3 for triangle and hexagon grids) and the count of each
+        grid (in the column `count`, or the weight column if given),
+        sorted by the grid ID. The records of missing coordinates are
+        counted in the grid of the minimum int64 index, as `GPS_to_grid`
+        gives them.
+    '''
+    params = GridParams.from_params(params)
+    grid = np.array([], dtype=np.int64)
+    total = np.array([])
+    for chunk in chunks:
+        if isinstance(chunk, pd.DataFrame):
+            chunk_grid = GPS_to_grid(chunk[col[0]].values,
+                                     chunk[col[1]].values,
+                                     params, packed=True)
+            if count is None:
+                weight = None
+            else:
+                weight = chunk[count].values
+        else:
+            chunk_grid = GPS_to_grid(*chunk, params, packed=True)
+            weight = None
+        chunk_grid = np.atleast_1d(chunk_grid)
+        # Merge the counts of the chunk into the aggregate
+        grid, inverse = np.unique(np.concatenate([grid, chunk_grid]),
+                                  return_inverse=True)
+        total = np.bincount(inverse, weights=np.concatenate([
+            total,
+            np.ones(len(chunk_grid)) if weight is None else weight]),
+            minlength=len(grid))
+    if params.method == 'rect':
+        columns = ['LONCOL', 'LATCOL']
+    else:
+        columns = ['loncol_1', 'loncol_2', 'loncol_3']
+    data = pd.DataFrame(dict(zip(columns, packed_to_grid(grid, params))))
+    if count is None:
+        data['count'] = total.astype(np.int64)
+    else:
+        data[count] = total
+    return data
+
+
+def grid_to_packed(gridid, params):
+    '''
+    Pack the grid ID into a single int64 key. Grouping, sorting and
+    joining on the key is much faster than on the two or three columns
+    of the grid ID, and the keys sort in the same order as the grid ID.
+
+    Rect grids use 31 bits for each of LONCOL and LATCOL, so the index
+    should be within [-2^30, 2^30). Triangle and hexagon grids use 21 bits
+    for each of loncol_1, loncol_2 and loncol_3, so the index should be
+    within [-2^20, 2^20).
+
+    The grid index of a missing (NaN) coordinate is the minimum int64.
+    Such grids are packed into the key `PACKED_INVALID`, also the minimum
+    int64, which unpacks back to the same grid index.
+
+    Parameters
+    -------
+    gridid : list
+        if `Rectangle grids`
+        [LONCOL,LATCOL] : Series
+            The two columns LONCOL and LATCOL together can specify a grid.
+
+        if `Triangle and Hexagon grids`
+        [loncol_1,loncol_2,loncol_3] : Series
+            The index of the triangle or hexagon grid.
+    params : list, dict or GridParams
+        Gridding parameters.
+        See https://transbigdata.readthedocs.io/en/latest/grids.html
+        for detail information about gridding parameters.
+
+    Returns
+    -------
+    grid : ndarray
+        The int64 key of the grid
+    '''
+    params = GridParams.from_params(params)
+    if params['method'] == 'rect':
+        bits = PACKED_BITS_RECT
+    else:
+        bits = PACKED_BITS_TRI
+    bias = 1 << (bits - 1)
+    gridid = [np.asarray(col, dtype=np.int64) for col in gridid]
+    # 坐标缺失的栅格
+    invalid = np.zeros(np.shape(gridid[0]), dtype=bool)
+    for col in gridid:
+        invalid |= col == PACKED_INVALID
+    grid = np.zeros(np.shape(gridid[0]), dtype=np.int64)
+    for col in gridid:
+        col = np.where(invalid, 0, col)
+        if ((col < -bias) | (col >= bias)).any():
+            raise ValueError(
+                'Grid index out of the range of the packed key')
+        grid = (grid << bits) | (col + bias)
+    grid = np.where(invalid, PACKED_INVALID, grid)
+    if grid.ndim == 0:
+        return grid[()]
+    return grid
+
+
+def packed_to_grid(grid, params):
+    '''
+    Unpack the int64 grid key generated by `grid_to_packed` or
+    `GPS_to_grid(..., packed=True)` into the grid ID.
+
+    Parameters
+    -------
+    grid : Series or ndarray
+        The int64 key of the grid
+    params : list, dict or GridParams
+        Gridding parameters.
+        See https://transbigdata.readthedocs.io/en/latest/grids.html
+        for detail information about gridding parameters.
+
+    Returns
+    -------
+
+    `Rectangle grids`
+    [LONCOL,LATCOL] : list
+        The two columns LONCOL and LATCOL together can specify a grid.
+
+    `Triangle and Hexagon grids`
+    [loncol_1,loncol_2,loncol_3] : list
+        The index of the triangle or hexagon grid.
+    '''
+    params = GridParams.from_params(params)
+    if params['method'] == 'rect':
+        bits, ncol = PACKED_BITS_RECT, 2
+    else:
+        bits, ncol = PACKED_BITS_TRI, 3
+    bias = 1 << (bits - 1)
+    mask = (1 << bits) - 1
+    grid = np.asarray(grid, dtype=np.int64)
+    invalid = grid == PACKED_INVALID
+    return [np.where(invalid, PACKED_INVALID,
+                     ((grid >> (bits * (ncol - 1 - i))) & mask) - bias)
+            for i in range(ncol)]
+
+
+PACKED_BITS_RECT = 31
+PACKED_BITS_TRI = 21
+PACKED_INVALID = np.iinfo(np.int64).min
 
 
 def grid_to_centre(gridid, params):
@@ -265,7 +591,7 @@ def grid_to_centre(gridid, params):
         [loncol_1,loncol_2,loncol_3] : Series
             The index of the grid latitude. The two columns LONCOL and
             LATCOL together can specify a grid.
-    params : list or dict
+    params : list, dict or GridParams
         Gridding parameters. 
         See https://transbigdata.readthedocs.io/en/latest/grids.html 
         for detail information about gridding parameters.
@@ -277,7 +603,7 @@ def grid_to_centre(gridid, params):
     HBLAT : Series
         The latitude of the grid center
     '''
-    params = convertparams(params)
+    params = GridParams.from_params(params)
     method = params['method']
     if method == 'rect':
         loncol, latcol = gridid
@@ -340,7 +666,7 @@ def grid_to_centre(gridid, params):
         return hblon.values, hblat.values
 
 
-def grid_to_polygon(gridid, params):
+def grid_to_polygon(gridid, params, return_coords=False):
     '''
     Generate the geometry column based on the grid ID.
     The input is the grid ID, the output is the geometry.
@@ -358,29 +684,37 @@ def grid_to_polygon(gridid, params):
             The index of the grid latitude. The two columns LONCOL and
             LATCOL together can specify a grid.
 
-    params : list or dict
+    params : list, dict or GridParams
         Gridding parameters. 
         See https://transbigdata.readthedocs.io/en/latest/grids.html 
         for detail information about gridding parameters.
+    return_coords : bool
+        If True, return the vertex coordinates of the grids instead of the
+        polygons, which is enough for rendering.
 
     Returns
     -------
-    geometry : Series
+    geometry : ndarray
         The column of grid geographic polygon
-
+    coords : ndarray
+        If return_coords is True, the (N, k, 2) array of the vertex
+        coordinates, k is 4, 3 and 6 for rect, tri and hexa grids
     '''
-    params = convertparams(params)
+    params = GridParams.from_params(params)
     method = params['method']
 
     if method == 'rect':
         loncol, latcol = gridid
-        return gridid_to_polygon_rect(loncol, latcol, params)
+        coords = gridid_to_coords_rect(loncol, latcol, params)
     if method == 'tri':
         loncol_1, loncol_2, loncol_3 = gridid
-        return gridid_to_polygon_tri(loncol_1, loncol_2, loncol_3, params)
+        coords = gridid_to_coords_tri(loncol_1, loncol_2, loncol_3, params)
     if method == 'hexa':
         loncol_1, loncol_2, loncol_3 = gridid
-        return gridid_to_polygon_hexa(loncol_1, loncol_2, loncol_3, params)
+        coords = gridid_to_coords_hexa(loncol_1, loncol_2, loncol_3, params)
+    if return_coords:
+        return coords
+    return shapely.polygons(coords)
 
 
 def grid_to_area(data, shape, params, col=['LONCOL', 'LATCOL']):
@@ -394,7 +728,7 @@ def grid_to_area(data, shape, params, col=['LONCOL', 'LATCOL']):
         Data, with two columns of grid ID
     shape : GeoDataFrame
         Geographic polygon
-    params : list or dict
+    params : list, dict or GridParams
         Gridding parameters. 
         See https://transbigdata.readthedocs.io/en/latest/grids.html 
         for detail information about gridding parameters.
@@ -464,6 +798,372 @@ def grid_to_params(grid):
     return params
 
 
+def grid_to_raster(gridid, params, weight=None, extent=None, time=None,
+                   ntime=None, sparse=False):
+    '''
+    Aggregate the rect grids into a raster, the counts (or the sums of the
+    weights) are written into a 2-D array indexed by the grid ID, or a
+    3-D (time, row, col) array if the time bins are given.
+
+    Parameters
+    -------
+    gridid : list
+        [LONCOL,LATCOL] : Series
+            The two columns LONCOL and LATCOL together can specify a grid.
+    params : list, dict or GridParams
+        Gridding parameters of rect grids.
+        See https://transbigdata.readthedocs.io/en/latest/grids.html
+        for detail information about gridding parameters.
+    weight : Series
+        The weight of each record, if None, the records are counted
+    extent : List
+        [LONCOL_min, LATCOL_min, LONCOL_max, LATCOL_max] of the raster,
+        both ends included. If None, the extent of the grids is used.
+        The grids out of the extent, and those of missing coordinates,
+        are dropped.
+    time : Series
+        The integer time bin of each record, from 0 to ntime-1
+    ntime : int
+        The number of time bins, if None, max(time)+1 is used
+    sparse : bool
+        If True, return scipy.sparse CSR matrices instead of arrays, a
+        list of matrices for the time bins
+
+    Returns
+    -------
+    raster : ndarray or csr_matrix
+        The raster, raster[LATCOL-LATCOL_min, LONCOL-LONCOL_min] (or
+        raster[time, LATCOL-LATCOL_min, LONCOL-LONCOL_min]), the first
+        row is the southmost one
+    extent : List
+        [LONCOL_min, LATCOL_min, LONCOL_max, LATCOL_max] of the raster
+    '''
+    params = GridParams.from_params(params)
+    if params.method != 'rect':
+        raise ValueError('The raster only supports rect grids')
+    loncol = np.atleast_1d(gridid[0]).astype(np.int64)
+    latcol = np.atleast_1d(gridid[1]).astype(np.int64)
+    # 坐标缺失的栅格不计入
+    valid = (loncol != PACKED_INVALID) & (latcol != PACKED_INVALID)
+    if extent is None:
+        if not valid.any():
+            raise ValueError('The extent is needed for empty grids')
+        extent = [loncol[valid].min(), latcol[valid].min(),
+                  loncol[valid].max(), latcol[valid].max()]
+    extent = [int(value) for value in extent]
+    ncol = extent[2] - extent[0] + 1
+    nrow = extent[3] - extent[1] + 1
+    col = loncol - extent[0]
+    row = latcol - extent[1]
+    flag = valid & (col >= 0) & (col < ncol) & (row >= 0) & (row < nrow)
+    if time is not None:
+        time = np.atleast_1d(time).astype(np.int64)
+        if ntime is None:
+            ntime = int(time.max()) + 1 if len(time) > 0 else 0
+        flag = flag & (time >= 0) & (time < ntime)
+        time = time[flag]
+    if weight is not None:
+        weight = np.atleast_1d(np.asarray(weight, dtype=float))[flag]
+    col = col[flag]
+    row = row[flag]
+    if sparse:
+        from scipy.sparse import coo_matrix
+        if weight is None:
+            weight = np.ones(len(col), dtype=np.int64)
+        if time is None:
+            # Duplicated entries are summed when converted to CSR
+            return coo_matrix((weight, (row, col)),
+                              shape=(nrow, ncol)).tocsr(), extent
+        raster = []
+        order = np.argsort(time, kind='stable')
+        bounds = np.searchsorted(time[order], np.arange(ntime + 1))
+        for t in range(ntime):
+            idx = order[bounds[t]:bounds[t + 1]]
+            raster.append(coo_matrix((weight[idx], (row[idx], col[idx])),
+                                     shape=(nrow, ncol)).tocsr())
+        return raster, extent
+    shape = (nrow, ncol)
+    index = row * ncol + col
+    if time is not None:
+        shape = (ntime, nrow, ncol)
+        index = time * (nrow * ncol) + index
+    raster = np.bincount(index, weights=weight,
+                         minlength=int(np.prod(shape))).reshape(shape)
+    return raster, extent
+
+
+def GPS_to_raster(lon, lat, params, weight=None, extent=None, time=None,
+                  ntime=None, sparse=False):
+    '''
+    Match the GPS data to the rect grids and aggregate them into a raster,
+    see `grid_to_raster`.
+
+    Parameters
+    -------
+    lon : Series
+        The column of longitude
+    lat : Series
+        The column of latitude
+    params : list, dict or GridParams
+        Gridding parameters of rect grids.
+        See https://transbigdata.readthedocs.io/en/latest/grids.html
+        for detail information about gridding parameters.
+    weight, extent, time, ntime, sparse :
+        See `grid_to_raster`
+
+    Returns
+    -------
+    raster : ndarray or csr_matrix
+        The raster
+    extent : List
+        [LONCOL_min, LATCOL_min, LONCOL_max, LATCOL_max] of the raster
+    '''
+    gridid = GPS_to_grid(lon, lat, params)
+    return grid_to_raster(gridid, params, weight=weight, extent=extent,
+                          time=time, ntime=ntime, sparse=sparse)
+
+
+def grid_neighbors(gridid, params, k=1, include_self=True):
+    '''
+    The neighbor grids within k rings of each grid, computed from the
+    grid ID arithmetically.
+
+    Rect grids: the (2k+1) x (2k+1) grids around the grid.
+    Triangle grids: the grids reached by crossing at most k edges.
+    Hexagon grids: the grids at most k steps away, 3k(k+1)+1 in total.
+
+    Parameters
+    -------
+    gridid : list
+        if `Rectangle grids`
+        [LONCOL,LATCOL] : Series
+            The two columns LONCOL and LATCOL together can specify a grid.
+
+        if `Triangle and Hexagon grids`
+        [loncol_1,loncol_2,loncol_3] : Series
+            The index of the triangle or hexagon grid.
+    params : list, dict or GridParams
+        Gridding parameters.
+        See https://transbigdata.readthedocs.io/en/latest/grids.html
+        for detail information about gridding parameters.
+    k : int
+        The number of rings
+    include_self : bool
+        Whether to include the grid itself
+
+    Returns
+    -------
+    index : ndarray
+        The position of the grid in the input of each neighbor
+    neighbors : list
+        The ID of the neighbor grids, in the same form as gridid
+    '''
+    params = GridParams.from_params(params)
+    gridid = np.array([np.atleast_1d(col) for col in gridid],
+                      dtype=np.int64).T
+    if params.method == 'rect':
+        offsets = rect_ring_offsets(k)[None, :, :]
+    elif params.method == 'tri':
+        # The offsets depend on the orientation of the triangle
+        flag = (gridid[:, 0] - gridid[:, 1] + gridid[:, 2] < 0)
+        offsets = tri_ring_offsets(k)[flag.astype(np.int64)]
+    else:
+        offsets = hexa_ring_offsets(k)[None, :, :]
+    if not include_self:
+        # The grid itself is the first offset
+        offsets = offsets[:, 1:, :]
+    neighbors = (gridid[:, None, :] + offsets).reshape(-1, gridid.shape[1])
+    index = np.repeat(np.arange(len(gridid)), offsets.shape[1])
+    return index, list(neighbors.T)
+
+
+@lru_cache(maxsize=None)
+def rect_ring_offsets(k):
+    # Offsets of the rect grids within k rings, the grid itself first
+    offsets = [(0, 0)] + [(i, j) for j in range(-k, k + 1)
+                          for i in range(-k, k + 1) if (i, j) != (0, 0)]
+    return np.array(offsets, dtype=np.int64)
+
+
+@lru_cache(maxsize=None)
+def hexa_ring_offsets(k):
+    # Offsets of the hexagon grids within k steps, the grid itself first.
+    # The centers of the adjacent hexagons are (2,1,-1) and (1,2,1) away.
+    offsets = [(0, 0, 0)]
+    for q in range(-k, k + 1):
+        for r in range(-k, k + 1):
+            if (max(abs(q), abs(r), abs(q + r)) <= k) & ((q, r) != (0, 0)):
+                i, j = 2 * q + r, q + 2 * r
+                offsets.append((i, j, j - i))
+    return np.array(offsets, dtype=np.int64)
+
+
+@lru_cache(maxsize=None)
+def tri_ring_offsets(k):
+    # Offsets of the triangle grids within k edges, the grid itself first,
+    # for the triangles with loncol_1-loncol_2+loncol_3 being 0 and -1
+    steps = {0: [(-1, 0, 0), (0, 1, 0), (0, 0, -1)],
+             -1: [(1, 0, 0), (0, -1, 0), (0, 0, 1)]}
+    result = []
+    for start in [(0, 0, 0), (0, 0, -1)]:
+        visited = [start]
+        ring = [start]
+        for _ in range(k):
+            nextring = []
+            for a, b, c in ring:
+                for da, db, dc in steps[a - b + c]:
+                    cell = (a + da, b + db, c + dc)
+                    if cell not in visited:
+                        visited.append(cell)
+                        nextring.append(cell)
+            ring = nextring
+        result.append(np.array(visited, dtype=np.int64) -
+                      np.array(start, dtype=np.int64))
+    return np.array(result)
+
+
+def params_to_parent(params, levels=1, factor=2):
+    '''
+    The gridding parameters of the coarser level in the grid pyramid of
+    rect grids. Each grid of the coarser level covers exactly
+    factor^levels x factor^levels grids of the given level, and the
+    grids of both levels share the same lower-left corner.
+
+    Parameters
+    -------
+    params : list, dict or GridParams
+        Gridding parameters of rect grids.
+        See https://transbigdata.readthedocs.io/en/latest/grids.html
+        for detail information about gridding parameters.
+    levels : int
+        How many levels up the pyramid
+    factor : int
+        The number of grids merged along each axis at each level
+
+    Returns
+    -------
+    params : GridParams
+        Gridding parameters of the coarser level
+    '''
+    params = GridParams.from_params(params)
+    if params.method != 'rect':
+        raise ValueError('The grid pyramid only supports rect grids')
+    scale = factor ** levels
+    # The center of the parent grid 0 is the center of the children
+    # from 0 to scale-1 along each axis
+    origin = params.origin + (scale - 1) / 2 * (params.R[0] + params.R[1])
+    gridsize = params.gridsize
+    if gridsize is not None:
+        gridsize = gridsize * scale
+    return params.replace(slon=origin[0],
+                          slat=origin[1],
+                          deltalon=params.deltalon * scale,
+                          deltalat=params.deltalat * scale,
+                          gridsize=gridsize)
+
+
+def grid_to_parent(gridid, levels=1, factor=2):
+    '''
+    The ID of the parent grid in the grid pyramid of rect grids, see
+    `params_to_parent` for the gridding parameters of the parent level.
+
+    Parameters
+    -------
+    gridid : list
+        [LONCOL,LATCOL] : Series
+            The two columns LONCOL and LATCOL together can specify a grid.
+    levels : int
+        How many levels up the pyramid
+    factor : int
+        The number of grids merged along each axis at each level
+
+    Returns
+    -------
+    [LONCOL,LATCOL] : list
+        The ID of the parent grid
+    '''
+    scale = factor ** levels
+    loncol, latcol = gridid
+    return [np.floor_divide(loncol, scale), np.floor_divide(latcol, scale)]
+
+
+def grid_to_children(gridid, levels=1, factor=2):
+    '''
+    The ID of the children grids in the grid pyramid of rect grids.
+
+    Parameters
+    -------
+    gridid : list
+        [LONCOL,LATCOL] : Series
+            The two columns LONCOL and LATCOL together can specify a grid.
+    levels : int
+        How many levels down the pyramid
+    factor : int
+        The number of grids merged along each axis at each level
+
+    Returns
+    -------
+    [LONCOL,LATCOL] : list
+        The ID of the children grids, each is an array of shape
+        (N, factor^levels * factor^levels), lat-major in each row
+    '''
+    scale = factor ** levels
+    loncol = np.atleast_1d(gridid[0]).astype(np.int64)
+    latcol = np.atleast_1d(gridid[1]).astype(np.int64)
+    offset_lon, offset_lat = np.meshgrid(np.arange(scale), np.arange(scale))
+    return [loncol[:, None] * scale + offset_lon.ravel(),
+            latcol[:, None] * scale + offset_lat.ravel()]
+
+
+def grid_pyramid(data, params, levels=3, factor=2,
+                 col=['LONCOL', 'LATCOL', 'count']):
+    '''
+    Roll up the grid counts through the grid pyramid of rect grids. Each
+    level is aggregated from the previous one, the GPS data is not
+    needed again.
+
+    Parameters
+    -------
+    data : DataFrame
+        Grid counts of the finest level
+    params : list, dict or GridParams
+        Gridding parameters of the finest level
+    levels : int
+        The number of coarser levels
+    factor : int
+        The number of grids merged along each axis at each level
+    col : List
+        Column names [LONCOL,LATCOL,count]
+
+    Returns
+    -------
+    pyramid : List
+        The grid counts of each level, from the finest to the coarsest,
+        the first one is the input data aggregated by grid
+    params : List
+        Gridding parameters of each level
+    '''
+    [loncol, latcol, count] = col
+    params = GridParams.from_params(params)
+    if params.method != 'rect':
+        raise ValueError('The grid pyramid only supports rect grids')
+    grid = grid_to_packed([data[loncol], data[latcol]], params)
+    level = pd.DataFrame({'grid': grid, count: data[count].values})
+    pyramid = []
+    params_list = []
+    for i in range(levels + 1):
+        level = level.groupby('grid')[count].sum().reset_index()
+        result = pd.DataFrame(
+            dict(zip([loncol, latcol], packed_to_grid(level['grid'], params))))
+        result[count] = level[count].values
+        pyramid.append(result)
+        params_list.append(params_to_parent(params, i, factor))
+        level['grid'] = grid_to_packed(
+            grid_to_parent([result[loncol].values, result[latcol].values],
+                           1, factor), params)
+    return pyramid, params_list
+
+
 def grid_params_optimize(data,
                          initialparams,
                          col=['uid', 'lon', 'lat'],
@@ -474,7 +1174,8 @@ def grid_params_optimize(data,
                          max_iter=50,
                          w=0.1,
                          c1=0.5,
-                         c2=0.5):
+                         c2=0.5,
+                         n_jobs=1):
     '''
     Optimize the grid params
 
@@ -494,6 +1195,9 @@ def grid_params_optimize(data,
         Sample the data as input, if 0 it will not perform sampling
     pop,max_iter,w,c1,c2:
         Params in PSO from scikit-opt
+    n_jobs : int
+        The number of processes to evaluate the particles of each
+        iteration in parallel, 1 to evaluate them in turn
 
     Returns
     -------
@@ -503,7 +1207,7 @@ def grid_params_optimize(data,
     if sample > 0:
         trajdata = data.sample(sample)
     else:
-        trajdata = data.copy()
+        trajdata = data
     params = initialparams
     times = 10
     theta_lambda = 1
@@ -519,115 +1223,17 @@ def grid_params_optimize(data,
             "Please install scikit-opt, run following code "
             "in cmd: pip install scikit-opt")
 
-    def grids_index_gini(gpsdata, params, col=['longitude', 'latitude']):
-        [lon, lat] = col
-        data = gpsdata.copy()
-        if params['method'] == 'rect':
-            data['LONCOL'], data['LATCOL'] = GPS_to_grid(data[lon],
-                                                         data[lat],
-                                                         params=params)
-            data['count'] = 1
-            data = data.groupby(['LONCOL', 'LATCOL'])[
-                'count'].sum().reset_index()
-        elif (params['method'] == 'tri') | (params['method'] == 'hexa'):
-            data['loncol_1'],\
-                data['loncol_2'],\
-                data['loncol_3'] = GPS_to_grid(data[lon],
-                                               data[lat],
-                                               params=params)
-            data['count'] = 1
-            data = data.groupby(['loncol_1', 'loncol_2', 'loncol_3'])[
-                'count'].sum().reset_index()
-
-        def GiniIndex(p):
-            N = len(p)
-            Q = np.mean(p)
-            G = 2 / (N * (N - 1)) * (
-                (N + 1) * np.sum(p) - 2 * np.sum([(N - (i + 1) + 1) * p[i]
-                                                  for i in range(len(p))]))
-            return G / (2 * Q)
-
-        Gini = GiniIndex(list(data['count']))
-        return Gini
-
-    def grids_index_centerdist(gpsdata, params, col=[lon, lat]):
-        [lon, lat] = col
-        data = gpsdata.copy()
-        data['HBLON'], data['HBLAT'] = grid_to_centre(
-            GPS_to_grid(data[lon],
-                        data[lat],
-                        params=params),
-            params=params)
-        data['dist'] = getdistance(data['HBLON'], data['HBLAT'], data[lon],
-                                   data[lat])
-        return data['dist'].quantile(0.5)
-
-    def grids_index_gridscount(gpsdata, params, col=[uid, lon, lat]):
-        [uid, lon, lat] = col
-        data = gpsdata.copy()
-        if params['method'] == 'rect':
-            data['LONCOL'], data['LATCOL'] = GPS_to_grid(data[lon],
-                                                         data[lat],
-                                                         params=params)
-            return data[[
-                uid, 'LONCOL', 'LATCOL'
-            ]].drop_duplicates().groupby(uid)['LONCOL'].count().quantile(0.5)
-        elif (params['method'] == 'tri') | (params['method'] == 'hexa'):
-            data['loncol_1'],\
-                data['loncol_2'],\
-                data['loncol_3'] = GPS_to_grid(data[lon],
-                                               data[lat],
-                                               params=params)
-            return data[[
-                uid, 'loncol_1', 'loncol_2', 'loncol_3'
-            ]].drop_duplicates().groupby(uid)['loncol_1'].count().quantile(0.5)
-
-    if optmethod == "centerdist":
-
-        def f_centerdist(x):
-            return grids_index_centerdist(trajdata, {
-                'slon': params['slon'] + x[0] / times,
-                'slat': params['slat'] + x[1] / times,
-                'deltalon': params['deltalon'],
-                'deltalat': params['deltalat'],
-                'method': params['method'],
-                'theta': x[2] / theta_lambda,
-            },
-                col=[lon, lat])
-
-        f = f_centerdist
-
-    elif optmethod == "gini":
-
-        def f_gini(x):
-            return -grids_index_gini(trajdata, {
-                'slon': params['slon'] + x[0] / times,
-                'slat': params['slat'] + x[1] / times,
-                'deltalon': params['deltalon'],
-                'deltalat': params['deltalat'],
-                'method': params['method'],
-                'theta': x[2] / theta_lambda,
-            },
-                col=[lon, lat])
-
-        f = f_gini
-    elif optmethod == "gridscount":
-
-        def f_gridscount(x):
-            return grids_index_gridscount(trajdata, {
-                'slon': params['slon'] + x[0] / times,
-                'slat': params['slat'] + x[1] / times,
-                'deltalon': params['deltalon'],
-                'deltalat': params['deltalat'],
-                'method': params['method'],
-                'theta': x[2] / theta_lambda,
-            },
-                col=[uid, lon, lat])
-
-        f = f_gridscount
-    else:
+    if optmethod not in ['centerdist', 'gini', 'gridscount']:
         raise Exception(
             'Method should be one of: centerdist,gini,gridscount')  # pragma: no cover
+    f = GridParamsObjective(trajdata[lon].values,
+                            trajdata[lat].values,
+                            trajdata[uid].values,
+                            params,
+                            optmethod,
+                            times=times,
+                            theta_lambda=theta_lambda,
+                            n_jobs=n_jobs)
 
     pso = PSO(func=f,
               n_dim=3,
@@ -639,20 +1245,24 @@ def grid_params_optimize(data,
               w=w,
               c1=c1,
               c2=c2)
-    result = pso.run()
+    try:
+        result = pso.run()
+    finally:
+        f.close()
 
     x = result[0]
+    params_optimized = f.x_to_params(x)
     params_optimized = {
-        'slon': params['slon'] + x[0] / times,
-        'slat': params['slat'] + x[1] / times,
-        'deltalon': params['deltalon'],
-        'deltalat': params['deltalat'],
-        'theta': x[2] / theta_lambda,
+        'slon': params_optimized['slon'],
+        'slat': params_optimized['slat'],
+        'deltalon': params_optimized['deltalon'],
+        'deltalat': params_optimized['deltalat'],
+        'theta': params_optimized['theta'],
         'method': method
     }
 
     if printlog:
-        print('Optimized index ' + optmethod + ':', f(result[0]))
+        print('Optimized index ' + optmethod + ':', f.evaluate(x))
         print('Optimized gridding params:', params_optimized)
         import matplotlib.pyplot as plt
         plt.figure(1, (14, 5), dpi=300)
@@ -662,8 +1272,9 @@ def grid_params_optimize(data,
         plt.xlabel('Iters')
         plt.title('Optimize cost')
         # 生成点的geodataframe
-        trajdata['geometry'] = gpd.points_from_xy(trajdata[lon], trajdata[lat])
-        trajdata = gpd.GeoDataFrame(trajdata)
+        trajdata = gpd.GeoDataFrame(
+            trajdata[[lon, lat]],
+            geometry=gpd.points_from_xy(trajdata[lon], trajdata[lat]))
         # 效果
         if method == 'rect':
             trajdata['LONCOL'], trajdata['LATCOL'] = GPS_to_grid(
@@ -698,6 +1309,139 @@ def grid_params_optimize(data,
     return params_optimized
 
 
+def gini_index(p):
+    '''
+    The Gini index of the counts in the given order, computed with the
+    cumulative sum instead of the weighted sum over every element.
+    '''
+    p = np.asarray(p)
+    N = len(p)
+    Q = np.mean(p)
+    # sum((N-i)*p[i]) for i in range(N) equals the sum of the cumsum
+    G = 2 / (N * (N - 1)) * (
+        (N + 1) * np.sum(p) - 2 * np.sum(np.cumsum(p)))
+    return G / (2 * Q)
+
+
+class GridParamsObjective:
+    '''
+    The objective of `grid_params_optimize` on preallocated coordinate
+    arrays. The instance is called by PSO with the whole population, the
+    values of evaluated particles are cached and the others can be
+    evaluated in a process pool.
+
+    Parameters
+    -------
+    lon, lat, uid : ndarray
+        The coordinates and the individual of the GPS points
+    params : list, dict or GridParams
+        Initial griding params
+    optmethod : str
+        The method to optimize: centerdist, gini, gridscount
+    times, theta_lambda : number
+        The scale of the particle position on slon/slat and theta
+    n_jobs : int
+        The number of processes to evaluate the population
+    '''
+    # Evaluate the whole population in one call, see sko.tools.set_run_mode
+    mode = 'vectorization'
+
+    def __init__(self, lon, lat, uid, params, optmethod,
+                 times=10, theta_lambda=1, n_jobs=1):
+        self.lon = np.asarray(lon, dtype=float)
+        self.lat = np.asarray(lat, dtype=float)
+        self.params = GridParams.from_params(params)
+        self.optmethod = optmethod
+        self.times = times
+        self.theta_lambda = theta_lambda
+        self.n_jobs = n_jobs
+        if optmethod == 'gridscount':
+            # Individuals with missing uid are dropped as in groupby
+            self.uid, _ = pd.factorize(np.asarray(uid))
+        else:
+            self.uid = None
+        self.cache = {}
+        self.pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def x_to_params(self, x):
+        return {
+            'slon': self.params['slon'] + x[0] / self.times,
+            'slat': self.params['slat'] + x[1] / self.times,
+            'deltalon': self.params['deltalon'],
+            'deltalat': self.params['deltalat'],
+            'method': self.params['method'],
+            'theta': x[2] / self.theta_lambda,
+        }
+
+    def evaluate(self, x):
+        key = np.asarray(x, dtype=float).tobytes()
+        if key not in self.cache:
+            self.cache[key] = self._evaluate(x)
+        return self.cache[key]
+
+    def _evaluate(self, x):
+        params = self.x_to_params(x)
+        if self.optmethod == 'centerdist':
+            hblon, hblat = grid_to_centre(
+                GPS_to_grid(self.lon, self.lat, params=params),
+                params=params)
+            dist = getdistance(np.atleast_1d(hblon), np.atleast_1d(hblat),
+                               self.lon, self.lat)
+            return np.nanquantile(dist, 0.5)
+        grid = GPS_to_grid(self.lon, self.lat, params=params, packed=True)
+        if self.optmethod == 'gini':
+            # The counts in the order of the grid key, as in groupby
+            _, counts = np.unique(grid, return_counts=True)
+            return -gini_index(counts)
+        # gridscount: number of distinct grids of each individual
+        flag = self.uid >= 0
+        grid, _ = pd.factorize(grid[flag])
+        key = pd.unique(self.uid[flag] * (grid.max() + 1) + grid)
+        counts = np.bincount(key // (grid.max() + 1))
+        return np.quantile(counts[counts > 0], 0.5)
+
+    def __call__(self, X):
+        X = np.asarray(X, dtype=float)
+        keys = [x.tobytes() for x in X]
+        todo = {}
+        for key, x in zip(keys, X):
+            if key not in self.cache:
+                todo[key] = x
+        if (self.n_jobs > 1) & (len(todo) > 1):
+            if self.pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.n_jobs,
+                    initializer=_init_objective,
+                    initargs=(self,))
+            values = self.pool.map(_evaluate_objective, list(todo.values()))
+            self.cache.update(zip(todo.keys(), values))
+        else:
+            for key, x in todo.items():
+                self.cache[key] = self._evaluate(x)
+        return np.array([self.cache[key] for key in keys])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def _init_objective(objective):
+    # Keep the objective in each worker so that the data is sent only once
+    global _worker_objective
+    _worker_objective = objective
+
+
+def _evaluate_objective(x):
+    return _worker_objective._evaluate(x)
+
+
 '''
 Utils
 '''
@@ -736,26 +1480,14 @@ def grid_to_centre_rect(loncol, latcol, params, from_origin=False):
     HBLAT : Series
         The latitude of the grid center
     '''
-    params = convertparams(params)
-    lonStart = params['slon']
-    latStart = params['slat']
-    deltaLon = params['deltalon']
-    deltaLat = params['deltalat']
-    theta = params['theta']
-
-    loncol = pd.Series(loncol)
-    latcol = pd.Series(latcol)
-    costheta = np.cos(theta * np.pi / 180)
-    sintheta = np.sin(theta * np.pi / 180)
-    R = np.array([[costheta * deltaLon, -sintheta * deltaLat],
-                  [sintheta * deltaLon, costheta * deltaLat]])
+    params = GridParams.from_params(params)
+    R = params.R
+    gridid = np.array([np.atleast_1d(loncol), np.atleast_1d(latcol)]).T
     if from_origin:
-        hblonhblat = np.dot(np.array([loncol.values, latcol.values]).T,   # pragma: no cover
-                            R) + np.array([lonStart, latStart]) - (
-                                R[0, :] / 2 + R[1, :] / 2)
+        hblonhblat = np.dot(gridid, R) + params.origin - (   # pragma: no cover
+            R[0, :] / 2 + R[1, :] / 2)
     else:
-        hblonhblat = np.dot(np.array([loncol.values, latcol.values]).T,
-                            R) + np.array([lonStart, latStart])
+        hblonhblat = np.dot(gridid, R) + params.origin
     hblon = hblonhblat[:, 0]
     hblat = hblonhblat[:, 1]
     if len(hblon) == 1:
@@ -797,28 +1529,12 @@ def GPS_to_grids_rect(lon, lat, params, from_origin=False):
         The index of the grid latitude. The two columns LONCOL and
         LATCOL together can specify a grid.
     '''
-    params = convertparams(params)
-    lonStart = params['slon']
-    latStart = params['slat']
-    deltaLon = params['deltalon']
-    deltaLat = params['deltalat']
-    theta = params['theta']
-
-    lon = pd.Series(lon)
-    lat = pd.Series(lat)
-    costheta = np.cos(theta * np.pi / 180)
-    sintheta = np.sin(theta * np.pi / 180)
-    R = np.array([[costheta * deltaLon, -sintheta * deltaLat],
-                  [sintheta * deltaLon, costheta * deltaLat]])
-    coords = np.array([lon, lat]).T
+    params = GridParams.from_params(params)
     if from_origin:
-        coords = coords - (np.array([lonStart, latStart]))
+        corner = params.origin
     else:
-        coords = coords - (np.array([lonStart, latStart]) - R[0, :] / 2 -
-                           R[1, :] / 2)
-    res = np.floor(np.dot(coords, np.linalg.inv(R)))
-    loncol = res[:, 0].astype(int)
-    latcol = res[:, 1].astype(int)
+        corner = params.corner
+    loncol, latcol = affine_floor(lon, lat, corner, params.R_inv.T)
     if len(loncol) == 1:
         loncol = loncol[0]
         latcol = latcol[0]
@@ -849,26 +1565,15 @@ def GPS_to_grids_tri(lon, lat, params):
     loncol_1,loncol_2,loncol_3 : Series
         The index of the triangle grid.
     '''
-    lon = pd.Series(lon, name='lon')
-    lat = pd.Series(lat, name='lat')
-
-    params = convertparams(params)
-    lonStart = params['slon']
-    latStart = params['slat']
-    deltaLon = params['deltalon']
-    deltaLat = params['deltalat']
-    theta = params['theta']
-    params = [lonStart, latStart, deltaLon, deltaLat, theta]
-
-    loncol_1, _ = GPS_to_grids_rect(lon, lat,
-                                    params=[*params[:4], theta+0],
-                                    from_origin=True)
-    loncol_2, _ = GPS_to_grids_rect(lon, lat,
-                                    params=[*params[:4], theta+60],
-                                    from_origin=True)
-    loncol_3, _ = GPS_to_grids_rect(lon, lat,
-                                    params=[*params[:4], theta+120],
-                                    from_origin=True)
+    params = GridParams.from_params(params)
+    # The triangle grids are the intersection of three rect grids rotated
+    # by 0, 60 and 120 degrees, only the first index of each is used
+    loncol_1, loncol_2, loncol_3 = affine_floor(
+        lon, lat, params.origin, params.R_inv_axes[:, :, 0])
+    if len(loncol_1) == 1:
+        loncol_1 = loncol_1[0]
+        loncol_2 = loncol_2[0]
+        loncol_3 = loncol_3[0]
     return loncol_1, loncol_2, loncol_3
 
 
@@ -896,78 +1601,104 @@ def GPS_to_grids_hexa(lon, lat, params):
     loncol_1,loncol_2,loncol_3 : Series
         The index of the hexagon grid.
     '''
-    lon = pd.Series(lon, name='lon')
-    lat = pd.Series(lat, name='lat')
-    params = convertparams(params)
-    lonStart = params['slon']
-    latStart = params['slat']
-    deltaLon = params['deltalon']
-    deltaLat = params['deltalat']
-    theta = params['theta']
-    params = [lonStart, latStart, deltaLon, deltaLat, theta]
+    kernels = numba_kernels()
+    if kernels is not None:
+        params = GridParams.from_params(params)
+        lon, lat = float_arrays(lon, lat)
+        return tuple(kernels.hexa_assign(
+            lon, lat, params.origin[0], params.origin[1],
+            np.ascontiguousarray(params.R_inv_axes[:, :, 0]),
+            HEXA_OFFSET_TABLE))
+    loncol_1, loncol_2, loncol_3 = GPS_to_grids_tri(lon, lat, params)
+    loncol_1 = np.atleast_1d(loncol_1).astype(np.int64)
+    loncol_2 = np.atleast_1d(loncol_2).astype(np.int64)
+    loncol_3 = np.atleast_1d(loncol_3).astype(np.int64)
+    # The triangle indexes satisfy loncol_1-loncol_2+loncol_3 in {-1, 0}.
+    # Floating point error at the lattice vertices may break it by one,
+    # snap loncol_3 back onto the lattice in that case.
+    flag = loncol_1 - loncol_2 + loncol_3
+    loncol_3 = loncol_3 - (flag > 0) + (flag < -1)
+    # Each triangle belongs to exactly one hexagon, which is decided by the
+    # residues of its indexes modulo 3
+    offset = HEXA_OFFSET_TABLE[(loncol_1 % 3) * 9 +
+                               (loncol_2 % 3) * 3 +
+                               (loncol_3 % 3)]
+    # Missing coordinates keep the minimum int64 index, as rect and
+    # triangle grids
+    invalid = loncol_1 == PACKED_INVALID
+    return tuple(np.where(invalid, PACKED_INVALID, col + offset[:, i])
+                 for i, col in enumerate([loncol_1, loncol_2, loncol_3]))
+
+
+def affine_floor(lon, lat, corner, m):
+    # Grid index along each row of m, floor((lon, lat) - corner) @ m.T.
+    # The products are summed elementwise rather than by the matrix
+    # product, so that both backends round in the same way.
+    lon, lat = float_arrays(lon, lat)
+    kernels = numba_kernels()
+    if kernels is not None:
+        return kernels.affine_floor(lon, lat, float(corner[0]),
+                                    float(corner[1]),
+                                    np.ascontiguousarray(m, dtype=float))
+    dx = lon - corner[0]
+    dy = lat - corner[1]
+    return np.array([np.floor(dx * m0 + dy * m1) for m0, m1 in m]
+                    ).astype(np.int64).reshape(len(m), len(dx))
+
+
+def is_hexa_center(i, j, k):
+    # Whether the triangle vertex (i, j, k) is the center of a hexagon
+    return ((((i-1) % 3) == 0) & (((j-1) % 3) == 0) & ((k % 3) == 0)) | \
+        ((((i-2) % 3) == 0) & ((j % 3) == 0) & (((k+2) % 3) == 0)) | \
+        (((i % 3) == 0) & (((j+1) % 3) == 0) & (((k+1) % 3) == 0))
+
+
+def hexa_offset_table():
+    # Offset from the triangle (loncol_1, loncol_2, loncol_3) to the center
+    # of its hexagon, indexed by the residues of the triangle indexes
+    # modulo 3. The candidate vertices of each triangle are tried in turn.
+    candidates = [(1, 1, 1), (1, 1, 0), (1, 0, 0),
+                  (0, 1, 1), (0, 0, 1), (0, 0, 0)]
+    table = np.zeros((27, 3), dtype=np.int64)
+    for i in range(3):
+        for j in range(3):
+            for k in range(3):
+                for offset in candidates:
+                    if is_hexa_center(i+offset[0], j+offset[1], k+offset[2]):
+                        table[i*9+j*3+k] = offset
+                        break
+    return table
+
+
+HEXA_OFFSET_TABLE = hexa_offset_table()
+
+
+def gridid_to_coords_rect(loncol, latcol, params):
+    '''
+    Generate the vertex coordinates of the rect grids based on the grid ID.
 
-    loncol_1, _ = GPS_to_grids_rect(lon, lat,
-                                    params=[*params[:4], theta+0],
-                                    from_origin=True)
-    loncol_2, _ = GPS_to_grids_rect(lon, lat,
-                                    params=[*params[:4], theta+60],
-                                    from_origin=True)
-    loncol_3, _ = GPS_to_grids_rect(lon, lat,
-                                    params=[*params[:4], theta+120],
-                                    from_origin=True)
-    tmp = pd.DataFrame()
-    tmp['lon'] = lon
-    tmp['lat'] = lat
-    tmp['loncol_1'] = loncol_1
-    tmp['loncol_2'] = loncol_2
-    tmp['loncol_3'] = loncol_3
-    tmp['id'] = range(len(tmp))
-    tmp1 = tmp[['loncol_1', 'loncol_2', 'loncol_3']].drop_duplicates()
-    loncol_1 = tmp1['loncol_1']
-    loncol_2 = tmp1['loncol_2']
-    loncol_3 = tmp1['loncol_3']
-    center = pd.concat(
-        [pd.DataFrame(
-            np.array(
-                [loncol_1+1, loncol_2+1, loncol_3+1,
-                 loncol_1, loncol_2, loncol_3]).T),
-         pd.DataFrame(
-            np.array(
-                [loncol_1+1, loncol_2+1, loncol_3,
-                 loncol_1, loncol_2, loncol_3]).T),
-         pd.DataFrame(
-            np.array(
-                [loncol_1+1, loncol_2, loncol_3,
-                 loncol_1, loncol_2, loncol_3]).T),
-         pd.DataFrame(
-            np.array(
-                [loncol_1, loncol_2+1, loncol_3+1,
-                 loncol_1, loncol_2, loncol_3]).T),
-         pd.DataFrame(
-            np.array(
-                [loncol_1, loncol_2, loncol_3+1,
-                 loncol_1, loncol_2, loncol_3]).T),
-         pd.DataFrame(
-             np.array(
-                 [loncol_1, loncol_2, loncol_3,
-                  loncol_1, loncol_2, loncol_3]).T)]).drop_duplicates()
-    center.columns = ['i', 'j', 'k', 'loncol_1', 'loncol_2', 'loncol_3']
-    center = center[((((center['i']-1) % 3) == 0) &
-                     (((center['j']-1) % 3) == 0) &
-                     (((center['k']) % 3) == 0)) |
-                    ((((center['i']-2) % 3) == 0) &
-                     (((center['j']) % 3) == 0) &
-                     (((center['k']+2) % 3) == 0)) |
-                    ((((center['i']) % 3) == 0) &
-                     (((center['j']+1) % 3) == 0) &
-                     (((center['k']+1) % 3) == 0))
-                    ]
-    tmp = pd.merge(tmp, center, on=['loncol_1', 'loncol_2', 'loncol_3'])
-    tmp = tmp.sort_values(by='id')
-    loncol_1 = tmp['i'].values
-    loncol_2 = tmp['j'].values
-    loncol_3 = tmp['k'].values
-    return loncol_1, loncol_2, loncol_3
+    Parameters
+    -------
+    LONCOL : Series
+        The index of the grid longitude.
+        The two columns LONCOL and LATCOL together can specify a grid.
+    LATCOL : Series
+        The index of the grid latitude.
+        The two columns LONCOL and LATCOL together can specify a grid.
+    params : list, dict or GridParams
+        Gridding parameters.
+
+    Returns
+    -------
+    coords : ndarray
+        The (N, 4, 2) array of the vertex coordinates
+    '''
+    params = GridParams.from_params(params)
+    gridid = np.array([np.atleast_1d(loncol), np.atleast_1d(latcol)],
+                      dtype=float).T
+    offsets = np.array([[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5]])
+    vertex = gridid[:, None, :] + offsets[None, :, :]
+    return np.dot(vertex, params.R) + params.origin
 
 
 def gridid_to_polygon_rect(loncol, latcol, params):
@@ -993,35 +1724,10 @@ def gridid_to_polygon_rect(loncol, latcol, params):
 
     Returns
     -------
-    geometry : Series
+    geometry : ndarray
         The column of grid geographic polygon
     '''
-    params = convertparams(params)
-    lonStart = params['slon']
-    latStart = params['slat']
-    deltaLon = params['deltalon']
-    deltaLat = params['deltalat']
-    theta = params['theta']
-    loncol = pd.Series(loncol)
-    latcol = pd.Series(latcol)
-    costheta = np.cos(theta * np.pi / 180)
-    sintheta = np.sin(theta * np.pi / 180)
-    R = np.array([[costheta * deltaLon, -sintheta * deltaLat],
-                  [sintheta * deltaLon, costheta * deltaLat]])
-    res_a = np.array([loncol.values - 0.5, latcol.values - 0.5]).T
-    res_b = np.array([loncol.values + 0.5, latcol.values - 0.5]).T
-    res_c = np.array([loncol.values + 0.5, latcol.values + 0.5]).T
-    res_d = np.array([loncol.values - 0.5, latcol.values + 0.5]).T
-    hblonhblat_a = np.dot(res_a, R) + np.array([lonStart, latStart])
-    hblonhblat_b = np.dot(res_b, R) + np.array([lonStart, latStart])
-    hblonhblat_c = np.dot(res_c, R) + np.array([lonStart, latStart])
-    hblonhblat_d = np.dot(res_d, R) + np.array([lonStart, latStart])
-    a = hblonhblat_a
-    b = hblonhblat_b
-    c = hblonhblat_c
-    d = hblonhblat_d
-    from shapely.geometry import Polygon
-    return [Polygon([a[i], b[i], c[i], d[i], a[i]]) for i in range(len(a))]
+    return shapely.polygons(gridid_to_coords_rect(loncol, latcol, params))
 
 
 def gettripoints(loncol_1, loncol_2, loncol_3, params):
@@ -1086,6 +1792,75 @@ def gettripoints(loncol_1, loncol_2, loncol_3, params):
     return testpoint.round(6)
 
 
+def lattice_to_coords(u, params):
+    # Convert the coordinates (u0, u1) on the lattice of the triangle grids,
+    # where the vertices of the triangles are the integer points, to lon/lat
+    params = GridParams.from_params(params)
+    W = np.array([params.R_inv_axes[0][:, 0], params.R_inv_axes[1][:, 0]]).T
+    return np.dot(u, np.linalg.inv(W)) + params.origin
+
+
+# Vertices of the triangle (a, b, c) in lattice coordinates relative to
+# (a, b), for a-b+c = 0 and a-b+c = -1
+TRI_VERTEX_OFFSETS = np.array([[[0, 1], [1, 1], [0, 0]],
+                               [[1, 0], [0, 0], [1, 1]]])
+
+# Vertices of the hexagon centered on the vertex (i, j, k) in lattice
+# coordinates relative to (i, j)
+HEXA_VERTEX_OFFSETS = np.array([[-1, -1], [-1, 0], [0, 1],
+                                [1, 1], [1, 0], [0, -1]])
+
+
+def gridid_to_coords_tri(loncol_1, loncol_2, loncol_3, params):
+    '''
+    Generate the vertex coordinates of the triangle grids based on the
+    grid ID.
+
+    Parameters
+    -------
+    loncol_1,loncol_2,loncol_3 : Series
+        The index of the triangle grid.
+    params : list, dict or GridParams
+        Gridding parameters.
+
+    Returns
+    -------
+    coords : ndarray
+        The (N, 3, 2) array of the vertex coordinates
+    '''
+    loncol_1 = np.atleast_1d(loncol_1).astype(np.int64)
+    loncol_2 = np.atleast_1d(loncol_2).astype(np.int64)
+    loncol_3 = np.atleast_1d(loncol_3).astype(np.int64)
+    flag = (loncol_1 - loncol_2 + loncol_3 < 0).astype(np.int64)
+    u = np.array([loncol_1, loncol_2]).T[:, None, :] + \
+        TRI_VERTEX_OFFSETS[flag]
+    return lattice_to_coords(u, params).round(6)
+
+
+def gridid_to_coords_hexa(loncol_1, loncol_2, loncol_3, params):
+    '''
+    Generate the vertex coordinates of the hexagon grids based on the
+    grid ID.
+
+    Parameters
+    -------
+    loncol_1,loncol_2,loncol_3 : Series
+        The index of the hexagon grid.
+    params : list, dict or GridParams
+        Gridding parameters.
+
+    Returns
+    -------
+    coords : ndarray
+        The (N, 6, 2) array of the vertex coordinates
+    '''
+    loncol_1 = np.atleast_1d(loncol_1).astype(np.int64)
+    loncol_2 = np.atleast_1d(loncol_2).astype(np.int64)
+    u = np.array([loncol_1, loncol_2]).T[:, None, :] + \
+        HEXA_VERTEX_OFFSETS[None, :, :]
+    return lattice_to_coords(u, params).round(6)
+
+
 def gridid_to_polygon_tri(loncol_1, loncol_2, loncol_3, params):
     '''
     Generate the geometry column based on the grid ID.
@@ -1105,28 +1880,11 @@ def gridid_to_polygon_tri(loncol_1, loncol_2, loncol_3, params):
 
     Returns
     -------
-    geometry : Series
+    geometry : ndarray
         The column of grid geographic polygon
     '''
-    params = convertparams(params)
-    lonStart = params['slon']
-    latStart = params['slat']
-    deltaLon = params['deltalon']
-    deltaLat = params['deltalat']
-    theta = params['theta']
-    params = [lonStart, latStart, deltaLon, deltaLat, theta]
-
-    loncol_1 = pd.Series(loncol_1, name='i')
-    loncol_2 = pd.Series(loncol_2, name='j')
-    loncol_3 = pd.Series(loncol_3, name='k')
-
-    testpoint = gettripoints(loncol_1, loncol_2, loncol_3, params)
-
-    geometry = testpoint.apply(
-        lambda r: Polygon(np.array([[r['p1_x'], r['p1_y']],
-                                    [r['p2_x'], r['p2_y']],
-                                    [r['p3_x'], r['p3_y']]]).round(6)), axis=1)
-    return list(geometry)
+    return shapely.polygons(
+        gridid_to_coords_tri(loncol_1, loncol_2, loncol_3, params))
 
 
 def gridid_to_polygon_hexa(loncol_1, loncol_2, loncol_3, params):
@@ -1148,40 +1906,17 @@ def gridid_to_polygon_hexa(loncol_1, loncol_2, loncol_3, params):
 
     Returns
     -------
-    geometry : Series
+    geometry : ndarray
         The column of grid geographic polygon
     '''
-    i = pd.Series(loncol_1, name='i')
-    j = pd.Series(loncol_2, name='j')
-    k = pd.Series(loncol_3, name='k')
-    gridid = pd.DataFrame(np.array([i, j, k]).T, columns=['i', 'j', 'k'])
-    tmp = pd.concat([pd.DataFrame(np.array([i-1, j-1, k-1, i, j, k]).T),
-                     pd.DataFrame(np.array([i-1, j-1, k, i, j, k]).T),
-                     pd.DataFrame(np.array([i-1, j, k, i, j, k]).T),
-                     pd.DataFrame(np.array([i, j-1, k-1, i, j, k]).T),
-                     pd.DataFrame(np.array([i, j, k-1, i, j, k]).T),
-                     pd.DataFrame(np.array([i, j, k, i, j, k]).T)])
-    tmp.columns = ['loncol_1', 'loncol_2', 'loncol_3', 'i', 'j', 'k']
-    tmp['geometry'] = list(
-        gettripoints(
-            tmp['loncol_1'],
-            tmp['loncol_2'],
-            tmp['loncol_3'], params).apply(
-            lambda r: Polygon(
-                np.array([[r['p1_x'], r['p1_y']],
-                          [r['p2_x'], r['p2_y']],
-                          [r['p3_x'], r['p3_y']]]).round(6)), axis=1))
-    tmp = gpd.GeoDataFrame(tmp)
-    tmp['gridid'] = tmp['i'].astype(
-        'str')+','+tmp['j'].astype('str')+','+tmp['k'].astype('str')
-    tmp1 = merge_polygon(tmp, 'gridid')
-    geometry = pd.merge(gridid, pd.merge(
-        tmp1, tmp[['gridid', 'i', 'j', 'k']].drop_duplicates()))['geometry']
-    return list(geometry)
+    return shapely.polygons(
+        gridid_to_coords_hexa(loncol_1, loncol_2, loncol_3, params))
 
 
 def convertparams(params):
     # Convertparams from list to dict
+    if isinstance(params, GridParams):
+        return params
     if (type(params) == list) | (type(params) == tuple):
         if len(params) == 4:
             lonStart, latStart, deltaLon, deltaLat = params
@@ -1210,6 +1945,188 @@ def convertparams(params):
             'Method should be `rect`,`tri` or `hexa`')  # pragma: no cover
     return dicparams
 
+
+class GridParams(Mapping):
+    '''
+    Compiled gridding parameters.
+
+    An immutable and hashable version of the gridding parameters that
+    precomputes the affine transform between the coordinates and the grid
+    index, so that it is not rebuilt on every call. It can be used anywhere
+    the gridding parameters list or dict is accepted, and can be read like
+    the dict, e.g. `params['slon']`.
+
+    Use `GridParams.from_params` to convert the gridding parameters list or
+    dict, the compiled result is cached.
+
+    Parameters
+    -------
+    slon, slat : number
+        The center of the grid (0, 0)
+    deltalon, deltalat : number
+        The length and width of a single grid
+    theta : number
+        The angle of the grid
+    method : str
+        rect, tri or hexa
+    gridsize : number
+        Grid size (meter), optional
+
+    Attributes
+    -------
+    R : ndarray
+        The 2x2 matrix from grid index to coordinate offset
+    R_inv : ndarray
+        The inverse of R, from coordinate offset to grid index
+    R_inv_axes : ndarray
+        The inverse matrices of the three rect grids at theta, theta+60
+        and theta+120, used by triangle and hexagon grids
+    fingerprint : str
+        A stable fingerprint of the parameters, which does not change
+        between processes and can be used as cache key
+    '''
+    _keys = ('slon', 'slat', 'deltalon', 'deltalat', 'theta', 'method')
+
+    def __init__(self, slon, slat, deltalon, deltalat, theta=0,
+                 method='rect', gridsize=None):
+        if method not in ['rect', 'tri', 'hexa']:
+            raise ValueError(
+                'Method should be `rect`,`tri` or `hexa`')
+        set_attr = object.__setattr__
+        set_attr(self, 'slon', float(slon))
+        set_attr(self, 'slat', float(slat))
+        set_attr(self, 'deltalon', float(deltalon))
+        set_attr(self, 'deltalat', float(deltalat))
+        set_attr(self, 'theta', float(theta))
+        set_attr(self, 'method', method)
+        set_attr(self, 'gridsize', gridsize)
+        costheta = np.cos(self.theta * np.pi / 180)
+        sintheta = np.sin(self.theta * np.pi / 180)
+        set_attr(self, 'costheta', costheta)
+        set_attr(self, 'sintheta', sintheta)
+        R = rotation_matrix(self.deltalon, self.deltalat, self.theta)
+        R_inv = np.linalg.inv(R)
+        R_inv_axes = np.array([
+            R_inv,
+            np.linalg.inv(rotation_matrix(
+                self.deltalon, self.deltalat, self.theta+60)),
+            np.linalg.inv(rotation_matrix(
+                self.deltalon, self.deltalat, self.theta+120))])
+        for array in [R, R_inv, R_inv_axes]:
+            array.flags.writeable = False
+        set_attr(self, 'R', R)
+        set_attr(self, 'R_inv', R_inv)
+        set_attr(self, 'R_inv_axes', R_inv_axes)
+        origin = np.array([self.slon, self.slat])
+        # lower-left corner of the grid (0, 0)
+        corner = origin - R[0, :] / 2 - R[1, :] / 2
+        origin.flags.writeable = False
+        corner.flags.writeable = False
+        set_attr(self, 'origin', origin)
+        set_attr(self, 'corner', corner)
+        values = [float.hex(getattr(self, key)) for key in self._keys[:5]]
+        fingerprint = hashlib.sha1(
+            ','.join(values + [self.method]).encode()).hexdigest()[:16]
+        set_attr(self, 'fingerprint', fingerprint)
+
+    @classmethod
+    def from_params(cls, params):
+        '''
+        Compile the gridding parameters
+
+        Parameters
+        -------
+        params : list, dict or GridParams
+            Gridding parameters.
+            See https://transbigdata.readthedocs.io/en/latest/grids.html
+            for detail information about gridding parameters.
+
+        Returns
+        -------
+        params : GridParams
+            Compiled gridding parameters
+        '''
+        if isinstance(params, cls):
+            return params
+        params = convertparams(params)
+        gridsize = params.get('gridsize', None)
+        return _compile_params(
+            float(params['slon']), float(params['slat']),
+            float(params['deltalon']), float(params['deltalat']),
+            float(params['theta']), params['method'],
+            gridsize if gridsize is None else float(gridsize))
+
+    def replace(self, **kwargs):
+        '''
+        Return a new GridParams with the given parameters replaced
+        '''
+        values = dict(self)
+        values.setdefault('gridsize', None)
+        values.update(kwargs)
+        return GridParams(**values)
+
+    def to_dict(self):
+        '''
+        Return the gridding parameters as dict
+        '''
+        return dict(self)
+
+    def __getitem__(self, key):
+        if (key not in self._keys) & (key != 'gridsize'):
+            raise KeyError(key)
+        if (key == 'gridsize') & (self.gridsize is None):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        keys = self._keys
+        if self.gridsize is not None:
+            keys = keys + ('gridsize',)
+        return iter(keys)
+
+    def __len__(self):
+        return len(self._keys) + (self.gridsize is not None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('GridParams is immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError('GridParams is immutable')
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, key) for key in self._keys))
+
+    def __eq__(self, other):
+        if isinstance(other, GridParams):
+            return all(getattr(self, key) == getattr(other, key)
+                       for key in self._keys)
+        if isinstance(other, Mapping):
+            return dict(self) == dict(other)
+        return NotImplemented
+
+    def __reduce__(self):
+        return (GridParams, (self.slon, self.slat, self.deltalon,
+                             self.deltalat, self.theta, self.method,
+                             self.gridsize))
+
+    def __repr__(self):
+        return 'GridParams(' + ', '.join(
+            key + '=' + repr(value) for key, value in self.items()) + ')'
+
+
+@lru_cache(maxsize=256)
+def _compile_params(slon, slat, deltalon, deltalat, theta, method, gridsize):
+    return GridParams(slon, slat, deltalon, deltalat, theta, method,
+                      gridsize)
+
+
+def rotation_matrix(deltalon, deltalat, theta):
+    # The matrix from grid index to coordinate offset
+    costheta = np.cos(theta * np.pi / 180)
+    sintheta = np.sin(theta * np.pi / 180)
+    return np.array([[costheta * deltalon, -sintheta * deltalat],
+                     [sintheta * deltalon, costheta * deltalat]])
+
 '''
 Geohash
 '''
@@ -1289,7 +2206,200 @@ def encode(longitude, latitude, precision=12):
     return ''.join(geohash)
 
 
-def geohash_encode(lon, lat, precision=12):
+# Array engine. Up to 12 characters (60 bits) a geohash fits in one int64,
+# so encoding and decoding are done on integer bit arrays.
+GEOHASH_MAX_PRECISION = 12
+__base32_bytes = np.frombuffer(__base32.encode('ascii'), dtype=np.uint8)
+__decodetable = np.full(256, -1, dtype=np.int64)
+__decodetable[__base32_bytes] = np.arange(32)
+
+
+def _spread_bits(v):
+    # Spread the lower 32 bits of v to the even bit positions
+    v = v.astype(np.uint64) & np.uint64(0x00000000FFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def _compact_bits(v):
+    # Inverse of _spread_bits, collect the even bit positions of v
+    v = v.astype(np.uint64) & np.uint64(0x5555555555555555)
+    v = (v | (v >> np.uint64(1))) & np.uint64(0x3333333333333333)
+    v = (v | (v >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+    return v
+
+
+def _bisect_index(x, lo, hi, nbits):
+    # Index of the interval that `nbits` successive halvings of [lo, hi]
+    # end in, with the same `x > mid` rule as `encode`. All the interval
+    # edges are dyadic and exact in float64, so one correction step after
+    # the division gives the same result as the bit-by-bit loop.
+    n = 1 << nbits
+    w = (hi - lo) / n
+    k = np.ceil((x - lo) / w) - 1
+    k = np.nan_to_num(np.clip(k, 0, n - 1), nan=0).astype(np.int64)
+    k -= ((k > 0) & (x <= lo + k * w)).astype(np.int64)
+    k += ((k < n - 1) & (x > lo + (k + 1) * w)).astype(np.int64)
+    return k
+
+
+def geohash_encode_int(lon, lat, precision=12):
+    '''
+    Encode longitude and latitude arrays into packed integer geohash codes.
+    The code of each point holds the 5*precision geohash bits, so that
+    `geohash_int_to_str` gives the same string as `encode`.
+
+    Parameters
+    -------
+    lon : array-like
+        longitude
+    lat : array-like
+        latitude
+    precision : int
+        geohash precision, no more than 12
+
+    Returns
+    -------
+    code : ndarray
+        int64 geohash codes
+    '''
+    if precision > GEOHASH_MAX_PRECISION:
+        raise ValueError('Packed geohash supports precision up to '
+                         + str(GEOHASH_MAX_PRECISION))
+    nbits = 5 * precision
+    kernels = numba_kernels()
+    if (kernels is not None) and (np.ndim(lon) == 1):
+        return kernels.geohash_encode(*float_arrays(lon, lat), nbits)
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    lon_bits = (nbits + 1) // 2
+    lat_bits = nbits // 2
+    lon_idx = _bisect_index(lon, -180.0, 180.0, lon_bits)
+    lat_idx = _bisect_index(lat, -90.0, 90.0, lat_bits)
+    return _geohash_interleave(lon_idx, lat_idx, nbits)
+
+
+def _geohash_interleave(lon_idx, lat_idx, nbits):
+    # Interleave the longitude and latitude cell index into the geohash
+    # bits. Longitude takes the first bit, so it also takes the last one
+    # when the number of bits is odd.
+    odd = (np.asarray(nbits) % 2).astype(bool)
+    lon_bits = _spread_bits(np.asarray(lon_idx))
+    lat_bits = _spread_bits(np.asarray(lat_idx))
+    code = np.where(odd, lon_bits | (lat_bits << np.uint64(1)),
+                    (lon_bits << np.uint64(1)) | lat_bits)
+    return code.astype(np.int64)
+
+
+def _geohash_deinterleave(code, nbits):
+    # Inverse of _geohash_interleave
+    code = np.asarray(code, dtype=np.int64).astype(np.uint64)
+    odd = (np.asarray(nbits) % 2).astype(bool)
+    lon_idx = np.where(odd, _compact_bits(code),
+                       _compact_bits(code >> np.uint64(1))).astype(np.int64)
+    lat_idx = np.where(odd, _compact_bits(code >> np.uint64(1)),
+                       _compact_bits(code)).astype(np.int64)
+    return lon_idx, lat_idx
+
+
+def geohash_int_to_str(code, precision=12):
+    '''
+    Convert packed integer geohash codes to geohash strings
+
+    Parameters
+    -------
+    code : array-like
+        int64 geohash codes
+    precision : int
+        geohash precision of the codes
+
+    Returns
+    -------
+    geohash : ndarray
+        geohash strings
+    '''
+    code = np.asarray(code, dtype=np.int64).astype(np.uint64)
+    chars = np.empty((len(code), precision), dtype=np.uint8)
+    for p in range(precision):
+        shift = np.uint64(5 * (precision - 1 - p))
+        chars[:, p] = __base32_bytes[(code >> shift) & np.uint64(31)]
+    return chars.view('S' + str(precision)).ravel().astype(str)
+
+
+def geohash_str_to_int(geohash):
+    '''
+    Convert geohash strings to packed integer geohash codes
+
+    Parameters
+    -------
+    geohash : array-like
+        geohash strings, no longer than 12
+
+    Returns
+    -------
+    code : ndarray
+        int64 geohash codes
+    length : ndarray
+        The length of each geohash string
+    '''
+    geohash = np.asarray(geohash, dtype='S')
+    if geohash.dtype.itemsize > GEOHASH_MAX_PRECISION:
+        raise ValueError('Packed geohash supports precision up to '
+                         + str(GEOHASH_MAX_PRECISION))
+    chars = geohash.reshape(-1).view(np.uint8).reshape(
+        len(geohash.reshape(-1)), geohash.dtype.itemsize)
+    length = (chars > 0).sum(axis=1)
+    values = __decodetable[chars]
+    if ((values < 0) & (chars > 0)).any():
+        raise ValueError('Invalid character in geohash')
+    code = np.zeros(len(chars), dtype=np.int64)
+    for p in range(chars.shape[1]):
+        valid = p < length
+        code[valid] = (code[valid] << 5) | values[valid, p]
+    return code, length
+
+
+def geohash_decode_int(code, precision=12):
+    '''
+    Decode packed integer geohash codes to the cell center and the cell
+    half size
+
+    Parameters
+    -------
+    code : array-like
+        int64 geohash codes
+    precision : int or array-like
+        geohash precision of the codes
+
+    Returns
+    -------
+    lon, lat : ndarray
+        The center of the geohash cells
+    lon_err, lat_err : ndarray
+        Half of the width and height of the geohash cells
+    '''
+    code = np.asarray(code, dtype=np.int64)
+    nbits = 5 * np.asarray(precision, dtype=np.int64)
+    lon_bits = (nbits + 1) // 2
+    lat_bits = nbits // 2
+    lon_idx, lat_idx = _geohash_deinterleave(code, nbits)
+    lon_w = 360.0 / np.power(2.0, lon_bits)
+    lat_w = 180.0 / np.power(2.0, lat_bits)
+    lon_err = lon_w / 2
+    lat_err = lat_w / 2
+    lon = -180.0 + lon_idx * lon_w + lon_err
+    lat = -90.0 + lat_idx * lat_w + lat_err
+    return lon, lat, lon_err * np.ones(len(code)), lat_err * np.ones(len(code))
+
+
+def geohash_encode(lon, lat, precision=12, packed=False):
     '''
     Input latitude and longitude and precision, and encode geohash code
 
@@ -1301,28 +2411,62 @@ def geohash_encode(lon, lat, precision=12):
         latitude Series
     precision : number
         geohash precision
+    packed : bool
+        If True, return the geohash as int64 codes instead of strings.
+        Packed codes are faster to group, sort and join, and can be
+        decoded by `geohash_decode` with the same precision.
+        Only supported for precision no more than 12.
 
     Returns
     -------
     geohash : Series
         encoded geohash Series
     '''
-    tmp = pd.DataFrame()
-    tmp['lon'] = lon
-    tmp['lat'] = lat
-    geohash = tmp.apply(lambda r: encode(
-        r['lon'], r['lat'], precision), axis=1)
-    return geohash
-
-
-def geohash_decode(geohash):
+    index = lon.index if isinstance(lon, pd.Series) else None
+    if precision > GEOHASH_MAX_PRECISION:
+        if packed:
+            raise ValueError('Packed geohash supports precision up to '
+                             + str(GEOHASH_MAX_PRECISION))
+        tmp = pd.DataFrame()
+        tmp['lon'] = lon
+        tmp['lat'] = lat
+        geohash = tmp.apply(lambda r: encode(
+            r['lon'], r['lat'], precision), axis=1)
+        return geohash
+    code = geohash_encode_int(lon, lat, precision)
+    if packed:
+        return pd.Series(code, index=index)
+    return pd.Series(geohash_int_to_str(code, precision),
+                     index=index, dtype=object)
+
+
+def _geohash_decode_exactly(geohash, precision=12):
+    # Decode geohash Series (strings or packed codes) to
+    # (lon, lat, lon_err, lat_err) arrays
+    values = np.asarray(geohash)
+    if np.issubdtype(values.dtype, np.integer):
+        return geohash_decode_int(values, precision)
+    values = values.astype(str)
+    if (len(values) > 0) and \
+            (np.char.str_len(values).max() > GEOHASH_MAX_PRECISION):
+        res = np.array([decode_exactly(c) for c in values]).reshape(-1, 4)
+        return res[:, 0], res[:, 1], res[:, 2], res[:, 3]
+    code, length = geohash_str_to_int(values)
+    return geohash_decode_int(code, length)
+
+
+def geohash_decode(geohash, precision=12):
     '''
     Decode geohash code
 
     Parameters
     -------
     geohash : Series
-        encoded geohash Series
+        encoded geohash Series, either geohash strings or the packed
+        int64 codes from `geohash_encode(..., packed=True)`
+    precision : number
+        geohash precision of the packed codes. Only used when the input
+        is packed codes.
 
     Returns
     -------
@@ -1331,36 +2475,252 @@ def geohash_decode(geohash):
     lat : Series
         decoded latitude Series
     '''
-    lonslats = geohash.apply(decode)
-    lon = lonslats.apply(lambda r: r[0])
-    lat = lonslats.apply(lambda r: r[1])
-    return lon, lat
+    index = geohash.index if isinstance(geohash, pd.Series) else None
+    lon, lat, _, _ = _geohash_decode_exactly(geohash, precision)
+    return pd.Series(lon, index=index), pd.Series(lat, index=index)
+
+
+def _geohash_area(location):
+    # The geometry to cover from bounds, GeoDataFrame or shapely geometry
+    if (type(location) == list) | (type(location) == tuple):
+        return box(*location)
+    elif isinstance(location, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        return shapely.union_all(location.geometry.values)
+    return location
 
 
-def geohash_togrid(geohash):
+def geohash_cover(location, precision=6):
+    '''
+    The minimal set of geohash prefixes covering the bounds or shape at the
+    given precision. The geohash cells of the given precision that
+    intersect the area are merged into their prefix whenever all the 32
+    cells of the prefix are in the area, so the prefixes are no longer
+    than the precision.
+
+    Parameters
+    -------
+    location : bounds(List) or shape(GeoDataFrame)
+        Where to cover.
+        If bounds, [lon1, lat1, lon2, lat2](WGS84), where lon1 , lat1 are the
+        lower-left coordinates, lon2 , lat2 are the upper-right coordinates
+        If shape, it should be GeoDataFrame
+    precision : int
+        geohash precision, no more than 12
+
+    Returns
+    -------
+    geohash : Series
+        The sorted geohash prefixes. The cells only touching the area on
+        the boundary are not included.
+    '''
+    if precision > GEOHASH_MAX_PRECISION:
+        raise ValueError('Packed geohash supports precision up to '
+                         + str(GEOHASH_MAX_PRECISION))
+    area = _geohash_area(location)
+    shapely.prepare(area)
+    codes = np.arange(32, dtype=np.int64)
+    cover = []
+    for length in range(1, precision + 1):
+        lon, lat, lon_err, lat_err = geohash_decode_int(codes, length)
+        cells = shapely.box(lon - lon_err, lat - lat_err,
+                            lon + lon_err, lat + lat_err)
+        inside = shapely.covers(area, cells)
+        partial = shapely.intersects(area, cells) & \
+            ~shapely.touches(area, cells) & ~inside
+        if length == precision:
+            inside = inside | partial
+        cover.extend(geohash_int_to_str(codes[inside], length))
+        # Only the cells on the boundary of the area are refined
+        codes = (codes[partial][:, None] * 32 +
+                 np.arange(32, dtype=np.int64)).ravel()
+    return pd.Series(sorted(cover), dtype=object)
+
+
+def geohash_range(geohash):
+    '''
+    The range of the left-aligned 60 bit packed codes of the geohash
+    prefixes, see `GeohashIndex`.
+
+    Parameters
+    -------
+    geohash : Series
+        geohash prefixes, no longer than 12
+
+    Returns
+    -------
+    start, end : ndarray
+        The codes of the points with the prefix are in [start, end)
+    '''
+    code, length = geohash_str_to_int(np.asarray(geohash, dtype=str))
+    shift = 5 * (GEOHASH_MAX_PRECISION - length)
+    return code << shift, (code + 1) << shift
+
+
+class GeohashIndex:
+    '''
+    A sorted index over a geohash column. The geohashes are stored as
+    left-aligned 60 bit packed codes, so that the geohashes sharing a
+    prefix are a contiguous range of the index and can be found by
+    binary search.
+
+    Parameters
+    -------
+    geohash : Series
+        geohash strings, or the packed int64 codes from
+        `geohash_encode(..., packed=True)`
+    precision : int
+        geohash precision of the packed codes. Only used when the input
+        is packed codes.
+
+    Examples
+    -------
+    >>> index = tbd.GeohashIndex(data['geohash'])
+    >>> data.iloc[index.query([113.9, 22.5, 114.0, 22.6])]
+    '''
+
+    def __init__(self, geohash, precision=12):
+        values = np.asarray(geohash)
+        if np.issubdtype(values.dtype, np.integer):
+            code = values.astype(np.int64)
+            length = np.full(len(code), precision)
+        else:
+            code, length = geohash_str_to_int(values.astype(str))
+        if (length > GEOHASH_MAX_PRECISION).any():
+            raise ValueError('Packed geohash supports precision up to '
+                             + str(GEOHASH_MAX_PRECISION))
+        code = code << (5 * (GEOHASH_MAX_PRECISION - length))
+        self.order = np.argsort(code, kind='stable')
+        self.keys = code[self.order]
+        self.precision = int(length.max()) if len(length) > 0 else precision
+
+    def __len__(self):
+        return len(self.keys)
+
+    def query_prefix(self, geohash):
+        '''
+        The positions of the records starting with any of the geohash
+        prefixes
+
+        Parameters
+        -------
+        geohash : Series
+            geohash prefixes, no longer than 12
+
+        Returns
+        -------
+        positions : ndarray
+            The sorted positions of the records in the indexed column
+        '''
+        if len(geohash) == 0:
+            return np.array([], dtype=np.int64)
+        start, end = geohash_range(geohash)
+        start = np.searchsorted(self.keys, start, side='left')
+        end = np.searchsorted(self.keys, end, side='left')
+        # Gather the ranges [start, end) of the sorted keys at once
+        counts = end - start
+        offset = np.repeat(start - np.cumsum(counts) + counts, counts)
+        positions = self.order[np.arange(counts.sum()) + offset]
+        return np.unique(positions)
+
+    def query(self, location, precision=None):
+        '''
+        The positions of the records in the geohash cells intersecting the
+        bounds or shape, see `geohash_cover`
+
+        Parameters
+        -------
+        location : bounds(List) or shape(GeoDataFrame)
+            Where to query
+        precision : int
+            The precision of the cover, by default the precision of the
+            indexed geohashes. A smaller precision gives fewer ranges to
+            search but more records out of the area.
+
+        Returns
+        -------
+        positions : ndarray
+            The sorted positions of the records in the indexed column
+        '''
+        if precision is None:
+            precision = self.precision
+        return self.query_prefix(geohash_cover(location, precision))
+
+
+def geohash_togrid(geohash, precision=12):
     '''
     Input geohash code to generate geohash grid cell
 
     Parameters
     -------
     geohash : Series
-        encoded geohash Series
+        encoded geohash Series, either geohash strings or the packed
+        int64 codes from `geohash_encode(..., packed=True)`
+    precision : number
+        geohash precision of the packed codes. Only used when the input
+        is packed codes.
 
     Returns
     -------
     poly : Series
         grid cell polygon for geohash
     '''
-    lonslats = geohash.apply(decode_exactly)
-
-    def topoly(r):
-        (lon, lat, lon_err, lat_err) = r
-        from shapely.geometry import Polygon
-        return Polygon([[lon-lon_err, lat-lat_err],
-                        [lon-lon_err, lat+lat_err],
-                        [lon+lon_err, lat+lat_err],
-                        [lon+lon_err, lat-lat_err],
-                        [lon-lon_err, lat-lat_err],
-                        ])
-    poly = lonslats.apply(topoly)
-    return poly
+    index = geohash.index if isinstance(geohash, pd.Series) else None
+    lon, lat, lon_err, lat_err = _geohash_decode_exactly(geohash, precision)
+    lon1, lat1 = lon - lon_err, lat - lat_err
+    lon2, lat2 = lon + lon_err, lat + lat_err
+    coords = np.array([[lon1, lat1], [lon1, lat2],
+                       [lon2, lat2], [lon2, lat1]]).transpose(2, 0, 1)
+    return pd.Series(shapely.polygons(coords), index=index)
+
+
+def geohash_neighbors(geohash, precision=12, include_self=False):
+    '''
+    The 8 neighbor cells of the geohash cells. Longitude wraps around the
+    180th meridian, the neighbors beyond the poles are not included.
+
+    Parameters
+    -------
+    geohash : Series
+        encoded geohash Series, either geohash strings or the packed
+        int64 codes from `geohash_encode(..., packed=True)`
+    precision : number
+        geohash precision of the packed codes. Only used when the input
+        is packed codes.
+    include_self : bool
+        Whether to include the cell itself
+
+    Returns
+    -------
+    index : ndarray
+        The position of the cell in the input of each neighbor
+    neighbors : Series
+        The neighbor cells, in the same form as the input
+    '''
+    values = np.asarray(geohash)
+    packed = np.issubdtype(values.dtype, np.integer)
+    if packed:
+        code = values.astype(np.int64)
+        length = np.full(len(code), precision)
+    else:
+        code, length = geohash_str_to_int(values.astype(str))
+    nbits = 5 * length
+    lon_idx, lat_idx = _geohash_deinterleave(code, nbits)
+    offsets = [(i, j) for j in [-1, 0, 1] for i in [-1, 0, 1]
+               if include_self | ((i, j) != (0, 0))]
+    offsets = np.array(offsets, dtype=np.int64)
+    lon_n = 1 << ((nbits + 1) // 2)
+    lat_n = 1 << (nbits // 2)
+    neighbor_lon = (lon_idx[:, None] + offsets[:, 0]) % lon_n[:, None]
+    neighbor_lat = lat_idx[:, None] + offsets[:, 1]
+    flag = ((neighbor_lat >= 0) & (neighbor_lat < lat_n[:, None])).ravel()
+    index = np.repeat(np.arange(len(code)), len(offsets))[flag]
+    neighbor = _geohash_interleave(neighbor_lon.ravel()[flag],
+                                   neighbor_lat.ravel()[flag],
+                                   nbits[index])
+    if packed:
+        return index, pd.Series(neighbor)
+    result = np.empty(len(neighbor), dtype=object)
+    for p in np.unique(length):
+        idx = length[index] == p
+        result[idx] = geohash_int_to_str(neighbor[idx], p)
+    return index, pd.Series(result, dtype=object)
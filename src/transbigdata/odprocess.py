@@ -32,7 +32,12 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import geopandas as gpd
 import pandas as pd
-from .grids import GPS_to_grid, grid_to_centre
+from .grids import (
+    GPS_to_grid,
+    grid_to_centre,
+    grid_to_packed,
+    packed_to_grid
+)
 
 
 def odagg_grid(oddata, params, col=['slon', 'slat', 'elon', 'elat'],
@@ -75,8 +80,7 @@ def odagg_grid(oddata, params, col=['slon', 'slat', 'elon', 'elat'],
         oddata[elon], oddata[elat], params)
     if len(col) == 4:
         oddata[count] = 1
-    oddata_agg = oddata.groupby(['SLONCOL', 'SLATCOL', 'ELONCOL', 'ELATCOL'])[
-        count].sum().reset_index()
+    oddata_agg = _odagg_packed(oddata, params, count)
     oddata_agg['SHBLON'], oddata_agg['SHBLAT'] = grid_to_centre(
         [oddata_agg['SLONCOL'], oddata_agg['SLATCOL']], params)
     oddata_agg['EHBLON'], oddata_agg['EHBLAT'] = grid_to_centre(
@@ -148,9 +152,7 @@ def odagg_shape(oddata, shape, col=['slon', 'slat', 'elon', 'elat'],
             oddata[elon], oddata[elat], params)
         if len(col) == 4:
             oddata[count] = 1
-        oddata_agg = oddata.groupby([
-            'SLONCOL', 'SLATCOL', 'ELONCOL', 'ELATCOL'])[
-                count].sum().reset_index()
+        oddata_agg = _odagg_packed(oddata, params, count)
         oddata_agg['SHBLON'], oddata_agg['SHBLAT'] = grid_to_centre(
             [oddata_agg['SLONCOL'], oddata_agg['SLATCOL']], params)
         oddata_agg['EHBLON'], oddata_agg['EHBLAT'] = grid_to_centre(
@@ -213,6 +215,24 @@ def odagg_shape(oddata, shape, col=['slon', 'slat', 'elon', 'elat'],
     return oddata_agg
 
 
+def _odagg_packed(oddata, params, count):
+    # Aggregate the OD on the packed grid keys of the origin and destination
+    # instead of the four grid index columns
+    oddata_agg = pd.DataFrame({
+        'sgrid': grid_to_packed(
+            [oddata['SLONCOL'], oddata['SLATCOL']], params),
+        'egrid': grid_to_packed(
+            [oddata['ELONCOL'], oddata['ELATCOL']], params),
+        count: oddata[count].values})
+    oddata_agg = oddata_agg.groupby(['sgrid', 'egrid'])[
+        count].sum().reset_index()
+    oddata_agg['SLONCOL'], oddata_agg['SLATCOL'] = packed_to_grid(
+        oddata_agg['sgrid'], params)
+    oddata_agg['ELONCOL'], oddata_agg['ELATCOL'] = packed_to_grid(
+        oddata_agg['egrid'], params)
+    return oddata_agg[['SLONCOL', 'SLATCOL', 'ELONCOL', 'ELATCOL', count]]
+
+
 def tolinewitharrow(x1, y1, x2, y2, theta=20, length=0.1, pos=0.8):
     '''
     Input start and end coords，Returns LineString with arrow
@@ -37,9 +37,10 @@ from .grids import (
     GPS_to_grid,
     area_to_params,
     grid_to_centre,
-    grid_to_polygon
+    grid_to_polygon,
+    packed_to_grid
 )
-from .coordinates import getdistance
+from .coordinates import consecutive_distance
 
 
 def clean_outofbounds(data, bounds, col=['Lng', 'Lat']):
@@ -104,16 +105,14 @@ def clean_outofshape(data, shape, col=['Lng', 'Lat'], accuracy=500):
     shape_unary = shape.unary_union
     bounds = shape_unary.bounds
     params = area_to_params(bounds, accuracy)
-    data1 = data.copy()
-    data1['LONCOL'], data1['LATCOL'] = GPS_to_grid(
-        data1[Lng], data1[Lat], params)
-    data1_gdf = data1[['LONCOL', 'LATCOL']].drop_duplicates()
+    grid = GPS_to_grid(data[Lng], data[Lat], params, packed=True)
+    data1_gdf = pd.DataFrame({'grid': pd.unique(grid)})
     data1_gdf['geometry'] = grid_to_polygon(
-        [data1_gdf['LONCOL'], data1_gdf['LATCOL']], params)
+        packed_to_grid(data1_gdf['grid'], params), params)
     data1_gdf = gpd.GeoDataFrame(data1_gdf)
     data1_gdf = data1_gdf[data1_gdf.intersects(shape_unary)]
-    data1 = pd.merge(data1, data1_gdf[['LONCOL', 'LATCOL']]).drop(
-        ['LONCOL', 'LATCOL'], axis=1)
+    data1 = data[np.isin(grid, data1_gdf['grid'].values)].reset_index(
+        drop=True)
     return data1
 
 def dataagg(data, shape, col=['Lng', 'Lat', 'count'], accuracy=500):
@@ -152,14 +151,14 @@ def dataagg(data, shape, col=['Lng', 'Lat', 'count'], accuracy=500):
     bounds = shape_unary.bounds
     params = area_to_params(bounds, accuracy)
     data1 = data.copy()
-    data1['LONCOL'], data1['LATCOL'] = GPS_to_grid(
-        data1[Lng], data1[Lat], params)
-    data1_gdf = data1[['LONCOL', 'LATCOL']].drop_duplicates()
+    data1['_grid'] = GPS_to_grid(
+        data1[Lng], data1[Lat], params, packed=True)
+    data1_gdf = pd.DataFrame({'_grid': pd.unique(data1['_grid'])})
     data1_gdf['geometry'] = gpd.points_from_xy(
-        *grid_to_centre([data1_gdf['LONCOL'], data1_gdf['LATCOL']], params))
+        *grid_to_centre(packed_to_grid(data1_gdf['_grid'], params), params))
     data1_gdf = gpd.GeoDataFrame(data1_gdf)
     data1_gdf = gpd.sjoin(data1_gdf, shape, how='left')
-    data1 = pd.merge(data1, data1_gdf).drop(['LONCOL', 'LATCOL'], axis=1)
+    data1 = pd.merge(data1, data1_gdf, on='_grid').drop('_grid', axis=1)
     if aggcol:
         aggresult = pd.merge(shape, data1.groupby('index')[
                              aggcol].sum().reset_index()).drop('index', axis=1)
@@ -198,12 +197,13 @@ def id_reindex_disgap(data, col=['uid', 'lon', 'lat'], disgap=1000,
     '''
     uid, lon, lat = col
     data1 = data.copy()
-    data1[uid+suffix] = (
-        (data1[uid].shift() != data1[uid]) |
-        (getdistance(data1[lon],
-                     data1[lat],
-                     data1[lon].shift(),
-                     data1[lat].shift()) > disgap)).astype(int).cumsum()-1
+    # A new ID starts when the ID changes or the distance to the previous
+    # point exceeds disgap
+    uid_values = data1[uid].values
+    dis_next = consecutive_distance(data1[lon].values, data1[lat].values)
+    newid = np.ones(len(data1), dtype=bool)
+    newid[1:] = (uid_values[1:] != uid_values[:-1]) | (dis_next[:-1] > disgap)
+    data1[uid+suffix] = newid.cumsum()-1
     a = data1.groupby([uid+suffix])[lon].count()
     data1 = pd.merge(data1, a[a > 1].reset_index()[[uid+suffix]])
     return data1
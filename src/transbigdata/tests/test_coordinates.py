@@ -1,7 +1,8 @@
 import transbigdata as tbd
+import pytest
 import numpy as np
 import pandas as pd
-from shapely.geometry import Polygon
+from shapely.geometry import Polygon, MultiPolygon, LineString, Point
 import geopandas as gpd
 
 
@@ -80,3 +81,102 @@ class TestCoordinatesConverter:
                           [99.99224931,  30.99652903],
                           [99.99230228,  29.99681538]])
         assert np.allclose(result, truth)
+
+    def test_convert_out(self):
+        lon = self.data['LONGITUDE'].to_numpy().copy()
+        lat = self.data['LATITUDE'].to_numpy().copy()
+        truth = tbd.wgs84tobd09(self.data['LONGITUDE'], self.data['LATITUDE'])
+        assert (truth[0].index == self.data.index).all()
+        result = tbd.wgs84tobd09(lon, lat, out=(lon, lat))
+        assert result[0] is lon
+        assert np.array_equal(lon, truth[0])
+        assert np.array_equal(lat, truth[1])
+        out = (np.empty(3), np.empty(3))
+        with pytest.raises(ValueError):
+            tbd.gcj02towgs84(lon, lat, out=out)
+        assert tbd.bd09togcj02(bd_lon=116.4, bd_lat=39.9) == \
+            tbd.bd09togcj02(116.4, 39.9)
+        assert tbd.wgs84tobd09(lon=116.4, lat=39.9) == \
+            tbd.wgs84tobd09(116.4, 39.9)
+        assert tbd.bd09towgs84(lon=116.4, lat=39.9) == \
+            tbd.bd09towgs84(116.4, 39.9)
+
+    def test_gcj02_lattice(self, tmp_path):
+        lon = self.data['LONGITUDE']
+        lat = self.data['LATITUDE']
+        bounds = [121.35, 31.12, 121.42, 31.24]
+        lattice = tbd.GCJ02Lattice(bounds, 0.01, cache_dir=str(tmp_path))
+        assert lattice.max_error < 0.2
+        cached = tbd.GCJ02Lattice(bounds, 0.01, cache_dir=str(tmp_path))
+        assert np.array_equal(cached.dlon, lattice.dlon)
+        assert cached.max_error == lattice.max_error
+        truth = tbd.wgs84togcj02(lon, lat)
+        result = lattice.wgs84togcj02(lon, lat)
+        error = tbd.getdistance(truth[0], truth[1], result[0], result[1])
+        assert (error <= lattice.max_error * 1.01).all()
+        # points outside the lattice and strict tolerance use the exact
+        # formula
+        outside = lon > 121.43
+        assert np.array_equal(result[0][outside], truth[0][outside])
+        result = lattice.gcj02towgs84(lon, lat, tolerance=0)
+        assert np.array_equal(result[0], tbd.gcj02towgs84(lon, lat)[0])
+
+    def test_gcj02towgs84_exact(self):
+        lon = self.data['LONGITUDE']
+        lat = self.data['LATITUDE']
+        gcj_lon, gcj_lat = tbd.wgs84togcj02(lon, lat)
+        approx = tbd.gcj02towgs84(gcj_lon, gcj_lat)
+        assert tbd.getdistance(approx[0], approx[1], lon, lat).max() > 0.1
+        wgs_lon, wgs_lat, iterations, residual = tbd.gcj02towgs84(
+            gcj_lon, gcj_lat, exact=True, return_info=True)
+        assert tbd.getdistance(wgs_lon, wgs_lat, lon, lat).max() < 1e-3
+        assert (residual <= 1e-12).all()
+        assert (iterations > 1).all()
+        _, _, iterations, _ = tbd.gcj02towgs84(
+            gcj_lon, gcj_lat, exact=True, max_iter=2, return_info=True)
+        assert (iterations == 2).all()
+
+    def test_bd09mc_bands(self):
+        lon = pd.Series([116.404, 121.43, 87.6, 126.6, 109.5])
+        lat = pd.Series([39.915, 31.13, 43.8, 45.8, 18.25])
+        x, y = tbd.bd09tobd09mc(lon, lat)
+        assert np.allclose([x[0], y[0]], [12958175.0, 4825923.77])
+        # each point uses the band of its own latitude
+        lon2, lat2 = tbd.bd09mctobd09(x, y)
+        for i in range(len(x)):
+            assert np.allclose(tbd.bd09mctobd09(x[i], y[i]),
+                               (lon2[i], lat2[i]))
+        assert np.allclose(lon2, lon, atol=1e-5)
+        assert np.allclose(lat2, lat, atol=1e-5)
+
+    def test_transform_shape_parts(self):
+        poly = Polygon([[100, 30], [101, 30], [101, 31], [100, 31]],
+                       [[[100.2, 30.2], [100.5, 30.2], [100.5, 30.5]]])
+        gdf = gpd.GeoDataFrame(
+            geometry=[poly, MultiPolygon([poly, Polygon(
+                [[102, 30], [103, 31], [102, 31]])]),
+                LineString([[100, 30], [101, 31]]), Point(100, 30, 5)],
+            crs=4326)
+        result = tbd.transform_shape(gdf, tbd.gcj02towgs84)
+        assert result.crs == gdf.crs
+        assert list(result.geom_type) == list(gdf.geom_type)
+        assert len(result.geometry[0].interiors) == 1
+        assert len(result.geometry[1].geoms) == 2
+        assert result.geometry[3].z == 5
+        lon, lat = tbd.gcj02towgs84(100.2, 30.2)
+        assert np.allclose(result.geometry[0].interiors[0].coords[0],
+                           (lon, lat))
+
+    def test_consecutive_distance(self):
+        lon = self.data['LONGITUDE']
+        lat = self.data['LATITUDE']
+        group = self.data['BIKE_ID']
+        result = tbd.consecutive_distance(lon, lat, group)
+        truth = tbd.getdistance(lon, lat, lon.shift(-1), lat.shift(-1))
+        truth[group != group.shift(-1)] = np.nan
+        assert np.allclose(result, truth, equal_nan=True)
+        assert np.isnan(result.iloc[7]) and np.isnan(result.iloc[-1])
+        approx = tbd.consecutive_distance(lon, lat, group, method='equirect')
+        assert np.allclose(approx, truth, rtol=1e-5, equal_nan=True)
+        with pytest.raises(ValueError):
+            tbd.getdistance(lon, lat, lon, lat, method='vincenty')
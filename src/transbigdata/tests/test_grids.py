@@ -2,7 +2,8 @@ import transbigdata as tbd
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Polygon
+import pytest
+from shapely.geometry import Point, Polygon
 
 
 class TestGrids:
@@ -88,6 +89,20 @@ class TestGrids:
                             113.602246, 113.604492,
                             113.602246, 113.597754, 113.595509])
 
+    def test_geohash_packed(self):
+        lon = pd.Series([113.59550842, 113.60449158, -179.9, 0])
+        lat = pd.Series([22.4, 22.39640364, -89.9, 0])
+        code = tbd.geohash_encode(lon, lat, precision=7, packed=True)
+        assert code.dtype == np.int64
+        c = tbd.geohash_encode(lon, lat, precision=7)
+        assert list(c) == ['webz2vv', 'webz3jh', '0000d60', '7zzzzzz']
+        lon1, lat1 = tbd.geohash_decode(code, precision=7)
+        lon2, lat2 = tbd.geohash_decode(c)
+        assert np.array_equal(lon1.values, lon2.values)
+        assert np.array_equal(lat1.values, lat2.values)
+        assert np.allclose(lon2, lon, atol=0.0007)
+        assert np.allclose(lat2, lat, atol=0.0007)
+
     def test_regenerate_params(self):
         grid, params = tbd.area_to_grid(self.bounds, 500)
         result = tbd.grid_to_params(grid)
@@ -156,6 +171,262 @@ class TestGrids:
         truth = [[119.96516214],[31.29752543]]
         assert np.allclose(result,truth)
 
+    def test_hexa_assignment(self):
+        params = {'slon': 113.75,
+                  'slat':  22.4,
+                  'deltalon': 0.04871681446449111,
+                  'deltalat': 0.044966052064229066,
+                  'theta': 25,
+                  'method': 'hexa'}
+        lon = pd.Series([113.76, 113.81, 113.9, 114.02, 113.7, 113.95])
+        lat = pd.Series([22.41, 22.45, 22.52, 22.38, 22.6, 22.47])
+        loncol_1, loncol_2, loncol_3 = tbd.GPS_to_grid(lon, lat, params)
+        assert list(loncol_1) == [0, 0, 2, 5, -3, 3]
+        assert list(loncol_2) == [-1, -1, -3, 0, -4, -1]
+        assert list(loncol_3) == [-1, -1, -5, -5, -1, -4]
+
+    def test_gridparams(self):
+        params = tbd.GridParams.from_params(self.params)
+        assert params is tbd.GridParams.from_params(list(self.params))
+        assert params == tbd.GridParams.from_params(params)
+        assert params['method'] == 'rect'
+        assert dict(params) == {'slon': 113.6,
+                                'slat': 22.4,
+                                'deltalon': 0.004863669213934598,
+                                'deltalat': 0.004496605206422906,
+                                'theta': 0,
+                                'method': 'rect'}
+        assert len({params, tbd.GridParams(*self.params)}) == 1
+        assert params.fingerprint == tbd.GridParams(*self.params).fingerprint
+        assert params.fingerprint != params.replace(theta=10).fingerprint
+        assert np.allclose(np.dot(params.R, params.R_inv), np.eye(2))
+        assert tbd.GPS_to_grid(113.7, 22.7, params) == [21, 67]
+        assert np.allclose(tbd.grid_to_centre([21, 67], params),
+                           (113.70213705349262, 22.70127254883033))
+        grid, params1 = tbd.area_to_grid(self.bounds, params=params)
+        assert params1['gridsize'] == 500
+        assert len(grid) == len(tbd.area_to_grid(
+            self.bounds, params=self.params)[0])
+        with pytest.raises(AttributeError):
+            params.slon = 0
+        with pytest.raises(TypeError):
+            params['slon'] = 0
+        import pickle
+        assert pickle.loads(pickle.dumps(params)) == params
+
+    def test_params_optimize_parallel(self):
+        p = np.array([3, 1, 4, 1, 5, 9, 2, 6])
+        N = len(p)
+        G = 2 / (N * (N - 1)) * ((N + 1) * np.sum(p) - 2 * np.sum(
+            [(N - i) * p[i] for i in range(N)]))
+        assert tbd.grids.gini_index(p) == G / (2 * np.mean(p))
+        rng = np.random.default_rng(0)
+        data = pd.DataFrame({'uid': rng.integers(0, 20, 500),
+                             'lon': rng.uniform(113.7, 113.8, 500),
+                             'lat': rng.uniform(22.5, 22.6, 500)})
+        result = []
+        for n_jobs in [1, 2]:
+            np.random.seed(0)
+            result.append(tbd.grid_params_optimize(
+                data, self.params, optmethod='gini',
+                pop=4, max_iter=2, n_jobs=n_jobs))
+        assert result[0] == result[1]
+
+    def test_grid_chunks(self):
+        rng = np.random.default_rng(0)
+        data = pd.DataFrame({'lon': rng.uniform(113.6, 113.7, 1000),
+                             'lat': rng.uniform(22.4, 22.5, 1000),
+                             'w': rng.uniform(0, 1, 1000)})
+        for method in ['rect', 'hexa']:
+            params = tbd.GridParams(*self.params, theta=10, method=method)
+            chunks = [data.iloc[i:i + 300].copy() for i in range(0, 1000, 300)]
+            result = pd.concat(tbd.GPS_to_grid_chunks(chunks, params))
+            gridid = tbd.GPS_to_grid(data['lon'], data['lat'], params)
+            assert (result.iloc[:, 3:].values == np.array(gridid).T).all()
+            arrays = [(data['lon'].values[i:i + 300].astype(np.float32),
+                       data['lat'].values[i:i + 300].astype(np.float32))
+                      for i in range(0, 1000, 300)]
+            packed = np.concatenate(list(tbd.GPS_to_grid_chunks(
+                arrays, params, packed=True)))
+            assert len(packed) == 1000
+            count = tbd.grid_count_chunks(iter(chunks), params)
+            truth = data.assign(grid=tbd.GPS_to_grid(
+                data['lon'], data['lat'], params, packed=True)).groupby(
+                    'grid')['w'].agg(['count', 'sum'])
+            assert (count['count'].values == truth['count'].values).all()
+            weighted = tbd.grid_count_chunks(iter(chunks), params, count='w')
+            assert np.allclose(weighted['w'], truth['sum'])
+
+    def test_grid_pyramid(self):
+        rng = np.random.default_rng(0)
+        lon = rng.uniform(113.6, 113.7, 2000)
+        lat = rng.uniform(22.4, 22.5, 2000)
+        params = tbd.GridParams(*self.params, theta=20, gridsize=500)
+        gridid = tbd.GPS_to_grid(lon, lat, params)
+        parent = tbd.grid_to_parent(gridid, levels=2)
+        params2 = tbd.params_to_parent(params, levels=2)
+        assert params2['gridsize'] == 2000
+        assert np.allclose(tbd.GPS_to_grid(lon, lat, params2), parent)
+        children = tbd.grid_to_children(parent, levels=2)
+        assert children[0].shape == (2000, 16)
+        assert ((children[0] == gridid[0][:, None]) &
+                (children[1] == gridid[1][:, None])).any(axis=1).all()
+        data = pd.DataFrame({'LONCOL': gridid[0], 'LATCOL': gridid[1],
+                             'count': 1})
+        pyramid, params_list = tbd.grid_pyramid(data, params, levels=2)
+        assert len(pyramid) == 3
+        assert [level['count'].sum() for level in pyramid] == [2000] * 3
+        truth = pd.DataFrame({'LONCOL': parent[0], 'LATCOL': parent[1]})
+        truth = truth.groupby(['LONCOL', 'LATCOL']).size().values
+        assert (pyramid[2]['count'].values == truth).all()
+
+    def test_grid_neighbors(self):
+        rng = np.random.default_rng(0)
+        lon = rng.uniform(113.6, 113.8, 20)
+        lat = rng.uniform(22.4, 22.6, 20)
+        for method, n1, n2 in [('rect', 9, 25), ('tri', 4, 10),
+                               ('hexa', 7, 19)]:
+            params = tbd.GridParams(*self.params, theta=25, method=method)
+            gridid = tbd.GPS_to_grid(lon, lat, params)
+            index, neighbors = tbd.grid_neighbors(gridid, params, k=1)
+            assert len(index) == 20 * n1
+            assert (neighbors[0][::n1] == gridid[0]).all()
+            index, neighbors = tbd.grid_neighbors(
+                gridid, params, k=1, include_self=False)
+            polygon = tbd.grid_to_polygon(gridid, params)[index]
+            neighbor = tbd.grid_to_polygon(neighbors, params)
+            # The neighbors share an edge or a corner with the grid
+            assert all(a.distance(b) < 1e-6 for a, b in zip(polygon, neighbor))
+            assert all(a.intersection(b).area < 1e-10
+                       for a, b in zip(polygon, neighbor))
+            index, neighbors = tbd.grid_neighbors(gridid, params, k=2)
+            key = tbd.grid_to_packed(neighbors, params)
+            assert (pd.Series(key).groupby(index).nunique() == n2).all()
+
+    def test_raster(self):
+        rng = np.random.default_rng(0)
+        lon = rng.uniform(113.6, 113.7, 1000)
+        lat = rng.uniform(22.4, 22.5, 1000)
+        weight = rng.uniform(0, 1, 1000)
+        time = rng.integers(0, 4, 1000)
+        gridid = tbd.GPS_to_grid(lon, lat, self.params)
+        raster, extent = tbd.GPS_to_raster(lon, lat, self.params)
+        assert raster.sum() == 1000
+        assert raster.shape == (extent[3] - extent[1] + 1,
+                                extent[2] - extent[0] + 1)
+        count = pd.DataFrame({'LONCOL': gridid[0], 'LATCOL': gridid[1]})
+        count = count.groupby(['LONCOL', 'LATCOL']).size().reset_index()
+        assert (raster[count['LATCOL'] - extent[1],
+                       count['LONCOL'] - extent[0]] == count[0]).all()
+        raster, _ = tbd.grid_to_raster(gridid, self.params, weight=weight,
+                                       extent=[0, 0, 9, 9])
+        assert raster.shape == (10, 10)
+        assert np.isclose(raster.sum(), weight[
+            (gridid[0] <= 9) & (gridid[1] <= 9)].sum())
+        stack, _ = tbd.grid_to_raster(gridid, self.params, weight=weight,
+                                      extent=extent, time=time)
+        assert stack.shape[0] == 4
+        assert np.isclose(stack[2].sum(), weight[time == 2].sum())
+        matrices, _ = tbd.grid_to_raster(gridid, self.params, weight=weight,
+                                         extent=extent, time=time,
+                                         sparse=True)
+        assert np.allclose(
+            np.array([m.toarray() for m in matrices]), stack)
+
+    def test_geohash_index(self):
+        rng = np.random.default_rng(0)
+        lon = rng.uniform(113.5, 114.5, 5000)
+        lat = rng.uniform(22, 23, 5000)
+        bounds = [113.9, 22.5, 114.05, 22.62]
+        cover = tbd.geohash_cover(bounds, precision=5)
+        assert (cover.str.len() == 5).all()
+        assert (tbd.geohash_cover(bounds, precision=6).str.len() < 6).any()
+        geohash = tbd.geohash_encode(lon, lat, precision=7)
+        index = tbd.GeohashIndex(geohash)
+        positions = index.query(bounds, precision=5)
+        assert (positions == np.flatnonzero(
+            np.any([geohash.str.startswith(c) for c in cover], axis=0))).all()
+        inside = (lon > bounds[0]) & (lon < bounds[2]) & \
+            (lat > bounds[1]) & (lat < bounds[3])
+        assert np.isin(np.flatnonzero(inside), index.query(bounds)).all()
+        code = tbd.geohash_encode(lon, lat, precision=7, packed=True)
+        index = tbd.GeohashIndex(code, precision=7)
+        assert (index.query(bounds, precision=5) == positions).all()
+
+    def test_geohash_neighbors(self):
+        geohash = tbd.geohash_encode(np.array([114.0, 179.9999, 0]),
+                                     np.array([22.5, 10, 89.9999]),
+                                     precision=6)
+        index, neighbors = tbd.geohash_neighbors(geohash)
+        # The cell near the pole has no neighbors to the north
+        assert list(np.bincount(index)) == [8, 8, 5]
+        assert 'wecpfr' in list(neighbors[index == 0])
+        lon, lat, lon_err, lat_err = tbd.grids._geohash_decode_exactly(
+            neighbors)
+        lon0, lat0 = tbd.geohash_decode(geohash)
+        dlon = (lon - lon0.values[index] + 180) % 360 - 180
+        dlat = lat - lat0.values[index]
+        assert np.allclose(np.abs(dlon) / lon_err, [2, 0, 2, 2, 2, 2, 0, 2] * 2
+                           + [2, 0, 2, 2, 2])
+        assert np.allclose(np.abs(dlat) / lat_err, [2, 2, 2, 0, 0, 2, 2, 2] * 2
+                           + [2, 2, 2, 0, 0])
+        code = tbd.geohash_encode(np.array([114.0]), np.array([22.5]),
+                                  precision=6, packed=True)
+        _, packed = tbd.geohash_neighbors(code, precision=6)
+        assert (tbd.grids.geohash_int_to_str(packed, 6) ==
+                neighbors[index == 0].values).all()
+        grid = tbd.geohash_togrid(code, precision=6)
+        assert grid.iloc[0].equals(tbd.geohash_togrid(geohash).iloc[0])
+
+    def test_area_to_gridid(self):
+        for method in ['rect', 'tri', 'hexa']:
+            params = tbd.GridParams(*self.params, theta=25, method=method)
+            grid, _ = tbd.area_to_grid(self.bounds, params=params)
+            grid1, _ = tbd.area_to_grid(
+                self.bounds, params=params, tilesize=7)
+            assert grid.drop(columns='geometry').equals(
+                grid1.drop(columns='geometry'))
+            # Every point in the bounds falls in the generated grids
+            lon, lat = np.meshgrid(
+                np.linspace(self.bounds[0], self.bounds[2], 50),
+                np.linspace(self.bounds[1], self.bounds[3], 50))
+            key = tbd.GPS_to_grid(lon.ravel(), lat.ravel(), params,
+                                  packed=True)
+            cols = [col for col in grid.columns if col != 'geometry']
+            assert np.isin(key, tbd.grid_to_packed(
+                [grid[col] for col in cols], params)).all()
+
+    def test_polygon_coords(self):
+        for method, k in [('rect', 4), ('tri', 3), ('hexa', 6)]:
+            params = tbd.GridParams(*self.params, theta=25, method=method)
+            gridid = tbd.GPS_to_grid(
+                [113.7, 113.71, 113.8], [22.7, 22.75, 22.5], params)
+            coords = tbd.grid_to_polygon(gridid, params, return_coords=True)
+            assert coords.shape == (3, k, 2)
+            polygons = tbd.grid_to_polygon(gridid, params)
+            assert np.allclose(
+                [np.array(p.exterior.coords)[:-1] for p in polygons], coords)
+            # Each polygon contains the centre of its grid
+            lon, lat = tbd.grid_to_centre(gridid, params)
+            assert all(p.contains(Point(x, y))
+                       for p, x, y in zip(polygons, lon, lat))
+
+    def test_packed(self):
+        lon = pd.Series([113.7, 113.9, 114.1, 113.7])
+        lat = pd.Series([22.7, 22.5, 22.9, 22.5])
+        for method in ['rect', 'tri', 'hexa']:
+            params = tbd.GridParams(*self.params, theta=20, method=method)
+            gridid = tbd.GPS_to_grid(lon, lat, params)
+            grid = tbd.GPS_to_grid(lon, lat, params, packed=True)
+            assert grid.dtype == np.int64
+            assert (grid == tbd.grid_to_packed(gridid, params)).all()
+            for col, col1 in zip(gridid, tbd.packed_to_grid(grid, params)):
+                assert (np.asarray(col) == col1).all()
+            assert (np.argsort(grid, kind='stable') == np.lexsort(
+                gridid[::-1])).all()
+        with pytest.raises(ValueError):
+            tbd.grid_to_packed([[2**30], [0]], self.params)
+
     def test_params_optimize(self):
         data = pd.DataFrame([
             [34745, '20:27:43', 113.80684699999999, 22.623248999999998, 1, 27],
@@ -256,9 +527,24 @@ class TestGrids:
                                                     
     def test_area_to_grid(self):
 
+        # The grids overlapping the shape with a positive area. The
+        # sampler used before started one grid above the bottom of the
+        # shape and stopped one grid below its top for tri/hexa grids, it
+        # missed 9 triangles and 3 hexagons at the southern edge and the
+        # northern apex, which overlap the shape by at least 0.6% and 0.1%
+        # of their area
         assert len(tbd.area_to_grid(self.shape)[0]) == 30
-        assert len(tbd.area_to_grid(self.shape,method = 'tri')[0]) == 41
-        assert len(tbd.area_to_grid(self.shape,method = 'hexa')[0]) == 10
+        assert len(tbd.area_to_grid(self.shape,method = 'tri')[0]) == 50
+        assert len(tbd.area_to_grid(self.shape,method = 'hexa')[0]) == 13
+        # The grids only touching a shape aligned with the grid lines are
+        # not kept
+        params = tbd.area_to_params([113.6, 22.4, 113.7, 22.5], accuracy=500)
+        grid, _ = tbd.area_to_grid([113.6, 22.4, 113.7, 22.5], params=params)
+        block = grid[grid['LONCOL'].between(3, 4) & grid['LATCOL'].between(3, 5)]
+        aligned = gpd.GeoDataFrame(geometry=[block.union_all()], crs='epsg:4326')
+        assert len(tbd.area_to_grid(aligned, params=params)[0]) == 6
+        # The bounds expanded by one grid, 7 x 8 grids overlap them
+        assert len(tbd.area_to_grid(self.bounds, accuracy=120)[0]) == 56
     def test_area_to_params(self):
         assert np.allclose(tbd.area_to_params(self.shape)['deltalat'], 0.004496605206422906)
 
@@ -294,3 +580,73 @@ class TestGrids:
         'method': 'rect'})
         assert np.allclose(tbd.grid_to_params(grids)['theta'],10)
 
+
+    def test_numba_backend(self):
+        pytest.importorskip('numba')
+        np.random.seed(0)
+        lon = pd.Series(np.random.uniform(113.7, 114.6, 1000))
+        lat = pd.Series(np.random.uniform(22.4, 22.9, 1000))
+
+        def run():
+            result = []
+            for method in ['rect', 'tri', 'hexa']:
+                params = tbd.area_to_params(
+                    [113.7, 22.4, 114.6, 22.9], accuracy=500, method=method)
+                params['theta'] = 10
+                result += list(tbd.GPS_to_grid(lon, lat, params))
+            result += list(tbd.wgs84togcj02(lon, lat))
+            result += list(tbd.gcj02towgs84(lon, lat))
+            result.append(tbd.getdistance(lon, lat, lat, lon))
+            result.append(tbd.geohash_encode(lon, lat, packed=True))
+            return result
+        expected = run()
+        try:
+            tbd.set_backend('numba')
+            assert tbd.get_backend() == 'numba'
+            result = run()
+        finally:
+            tbd.set_backend('numpy')
+        for r, e in zip(result, expected):
+            assert np.array_equal(np.asarray(r), np.asarray(e))
+        with pytest.raises(ValueError):
+            tbd.set_backend('cupy')
+
+    def test_missing_coordinates(self):
+        # The records of missing coordinates are kept as before the packed
+        # grid keys, in the grid of the minimum int64 index
+        lon = np.array([113.601, np.nan, 113.603, 113.602])
+        lat = np.array([22.401, 22.402, np.nan, 22.402])
+        invalid = np.iinfo(np.int64).min
+        for backend in ['numpy', 'numba']:
+            try:
+                tbd.set_backend(backend)
+                for method in ['rect', 'tri', 'hexa']:
+                    params = tbd.area_to_params(
+                        self.bounds, accuracy=100, method=method)
+                    gridid = tbd.GPS_to_grid(lon, lat, params)
+                    assert all((col[1:3] == invalid).all() for col in gridid)
+                    packed = tbd.GPS_to_grid(lon, lat, params, packed=True)
+                    for col, unpacked in zip(
+                            gridid, tbd.packed_to_grid(packed, params)):
+                        assert np.array_equal(col, unpacked)
+            finally:
+                tbd.set_backend('numpy')
+        params = tbd.area_to_params(self.bounds, accuracy=100)
+        count = tbd.grid_count_chunks([(lon[:2], lat[:2]), (lon[2:], lat[2:])],
+                                      params)
+        assert count['LONCOL'].iloc[0] == invalid
+        assert list(count['count']) == [2, 1, 1]
+        raster, extent = tbd.GPS_to_raster(lon, lat, params)
+        assert raster.sum() == 2
+        oddata = pd.DataFrame({'slon': lon, 'slat': lat,
+                               'elon': lon[::-1], 'elat': lat[::-1]})
+        oddata_agg = tbd.odagg_grid(oddata, params)
+        assert list(oddata_agg['count']) == [1, 1, 2]
+        assert (oddata_agg['SLONCOL'].iloc[-1] == invalid)
+        data = pd.DataFrame({'Lng': lon, 'Lat': lat, 'count': [1, 2, 3, 4]})
+        assert len(tbd.clean_outofshape(data, self.shape, col=['Lng', 'Lat'],
+                                        accuracy=100)) == 2
+        aggresult, data1 = tbd.dataagg(data, self.shape.copy(),
+                                       accuracy=100)
+        assert aggresult['count'].sum() == 5
+        assert len(data1) == 4
@@ -74,4 +74,108 @@ class TestMobile:
         import osmnx as ox
         traj = pd.read_csv(os.path.join(os.path.dirname(__file__), 'data', 'traj2.csv'))
         G = ox.load_graphml(os.path.join(os.path.dirname(__file__), 'data', 'G.graphml'))
-        assert len(tbd.traj_mapmatch(traj,G,col=['lon','lat']))==14
\ No newline at end of file
+        assert len(tbd.traj_mapmatch(traj,G,col=['lon','lat']))==14
+        matched = tbd.traj_mapmatch(traj, G, col=['lon', 'lat'], maxdist=10)
+        assert list(matched.index) == list(traj.index)
+        assert matched['u'].isnull().sum() == 2
+        assert (matched['dist'].dropna() <= 10).all()
+        assert matched['lon'].isnull().equals(matched['dist'].isnull())
+
+    def test_traj_smooth_batch(self):
+        np.random.seed(0)
+        data = pd.DataFrame({
+            'id': np.repeat(['a', 'b', 'c'], [5, 1, 8]),
+            'time': pd.Timestamp('2024-01-01') + pd.to_timedelta(
+                np.random.randint(1, 60, 14).cumsum(), 's'),
+            'lon': 121 + np.random.normal(0, 1e-3, 14),
+            'lat': 31 + np.random.normal(0, 1e-3, 14)})
+        smoothed = tbd.traj_smooth(data.sample(frac=1, random_state=0),
+                                   col=['id', 'time', 'lon', 'lat'])
+        assert list(smoothed['id']) == list(data['id'])
+        rts = tbd.traj_smooth(data, col=['id', 'time', 'lon', 'lat'],
+                              method='rts', batch_size=6)
+        # the filter of each trajectory computed on its own
+        F = np.eye(4)
+        H = np.eye(4)[:2]
+        Q = np.eye(4) * 0.25
+        for _, traj in data.groupby('id'):
+            z = traj[['lon', 'lat']].values
+            dt = traj['time'].diff().dt.total_seconds().values
+            x = np.array([z[0, 0], z[0, 1], 0, 0])
+            P = np.eye(4)
+            result = [x]
+            covariances = [P]
+            for i in range(1, len(z)):
+                F[0, 2] = F[1, 3] = dt[i]
+                x = F @ x
+                P = F @ P @ F.T + Q
+                K = P @ H.T @ np.linalg.inv(H @ P @ H.T + np.eye(2))
+                x = x + K @ (z[i] - H @ x)
+                P = P - K @ H @ P
+                result.append(x)
+                covariances.append(P)
+            assert np.allclose(
+                smoothed.loc[traj.index, ['lon', 'lat']].values,
+                np.array(result)[:, :2])
+            # Rauch-Tung-Striebel backward pass
+            for i in range(len(z) - 2, -1, -1):
+                F[0, 2] = F[1, 3] = dt[i + 1]
+                C = covariances[i] @ F.T @ np.linalg.inv(
+                    F @ covariances[i] @ F.T + Q)
+                result[i] = result[i] + C @ (result[i + 1] - F @ result[i])
+            assert np.allclose(rts.loc[traj.index, ['lon', 'lat']].values,
+                               np.array(result)[:, :2])
+
+    def test_traj_mapmatch_hmm(self):
+        import osmnx as ox
+        from shapely.geometry import LineString
+        traj = pd.read_csv(os.path.join(os.path.dirname(__file__), 'data', 'traj2.csv'))
+        G = ox.load_graphml(os.path.join(os.path.dirname(__file__), 'data', 'G.graphml'))
+        matched = tbd.traj_mapmatch_hmm(traj, G)
+        assert len(matched) == 14
+        assert matched.crs == tbd.traj_mapmatch(traj, G).crs == 'epsg:4326'
+        assert (matched['dist'].dropna() <= 50).all()
+        # batches of whole trajectories give the same result
+        batched = tbd.traj_mapmatch_hmm(traj, G, batch_size=1)
+        assert matched[['u', 'v', 'dist']].equals(batched[['u', 'v', 'dist']])
+        # the points along an edge are matched to it
+        u, v, data = next(
+            (u, v, data) for u, v, data in G.edges(data=True)
+            if data['length'] > 200)
+        line = data.get('geometry', None)
+        if line is None:
+            line = LineString([(G.nodes[u]['x'], G.nodes[u]['y']),
+                               (G.nodes[v]['x'], G.nodes[v]['y'])])
+        points = [line.interpolate(f, normalized=True)
+                  for f in np.linspace(0.2, 0.8, 5)]
+        traj = pd.DataFrame({
+            'id': 1, 'time': pd.date_range('2024-01-01', periods=5,
+                                           freq='10s'),
+            'lon': [p.x for p in points], 'lat': [p.y for p in points]})
+        matched = tbd.traj_mapmatch_hmm(traj, G)
+        assert (matched['dist'] < 1).all()
+        assert set(zip(matched['u'], matched['v'])) <= {(u, v), (v, u)}
+
+    def test_road_network_index(self, tmp_path):
+        import osmnx as ox
+        import pickle
+        traj = pd.read_csv(os.path.join(os.path.dirname(__file__), 'data', 'traj2.csv'))
+        G = ox.load_graphml(os.path.join(os.path.dirname(__file__), 'data', 'G.graphml'))
+        index = tbd.RoadNetworkIndex(G)
+        matched = tbd.traj_mapmatch(traj, G)
+        assert matched.equals(tbd.traj_mapmatch(traj, index))
+        matched_hmm = tbd.traj_mapmatch_hmm(traj, index)
+        # pickled, saved and memory-mapped indexes give the same result
+        path = str(tmp_path / 'network.npz')
+        index.save(path)
+        for loaded in [pickle.loads(pickle.dumps(index)),
+                       tbd.RoadNetworkIndex.load(path),
+                       tbd.RoadNetworkIndex.load(path, mmap_mode='r')]:
+            assert matched.equals(tbd.traj_mapmatch(traj, loaded))
+            assert matched_hmm.equals(tbd.traj_mapmatch_hmm(traj, loaded))
+        loaded = tbd.RoadNetworkIndex.load(path, mmap_mode='r')
+        assert isinstance(loaded.grid_segment, np.memmap)
+        # the suffix is added in the same way when saving and loading
+        index.save(tmp_path / 'network2')
+        loaded = tbd.RoadNetworkIndex.load(tmp_path / 'network2')
+        assert matched.equals(tbd.traj_mapmatch(traj, loaded))
@@ -33,14 +33,13 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import geopandas as gpd
 import pandas as pd
 import numpy as np
+import shapely
+import os
 from .preprocess import id_reindex
-from .coordinates import getdistance
+from .coordinates import getdistance, consecutive_distance
 from .grids import GPS_to_grid
 import osmnx as ox
-from .coordinates import getdistance
-from .gisprocess import ckdnearest_line
 import numpy as np
-from pykalman import KalmanFilter
 from pyproj import CRS
 
 def traj_length(move_points,col = [ 'lon', 'lat','moveid'],method = 'Haversine'):
@@ -73,22 +72,16 @@ def traj_length(move_points,col = [ 'lon', 'lat','moveid'],method = 'Haversine')
         # 计算每一条轨迹的长度
         move_trajs['length'] = move_trajs_proj.length
     elif method == 'Haversine':
-        # 对每一轨迹段计算长度
-        move_trajs = move_points.copy()
-        moveids = move_points[moveid].drop_duplicates()
-        # 将下一行的坐标平移至同一行，方便进行列运算
-        move_trajs[lon+'_next'] = move_trajs[lon].shift(-1)
-        move_trajs[lat+'_next'] = move_trajs[lat].shift(-1)
-        # 还需确保计算的是同一条轨迹的坐标点
-        move_trajs[moveid+'_next'] = move_trajs[moveid].shift(-1)
-        move_trajs = move_trajs[move_trajs[moveid]==move_trajs[moveid+'_next']]
-        # 计算每两点之间的长度，并统计整条轨迹的长度
-        move_trajs['length'] = getdistance(move_trajs[lon],move_trajs[lat],move_trajs[lon+'_next'],move_trajs[lat+'_next'])
-        move_trajs = move_trajs.groupby(moveid)['length'].sum().reset_index()
-        move_trajs = pd.merge(moveids,move_trajs,on = moveid,how = 'left').fillna(0)
+        # 计算每一点到同一轨迹下一点的距离，并统计整条轨迹的长度
+        move_trajs = move_points[[moveid]].copy()
+        move_trajs['length'] = consecutive_distance(
+            move_points[lon].values, move_points[lat].values,
+            move_points[moveid].values)
+        move_trajs = move_trajs.groupby(
+            moveid, sort=False)['length'].sum().reset_index()
     return move_trajs
 
-def traj_smooth(data,col = ['id','time','lon', 'lat'],proj = False,process_noise_std = 0.5, measurement_noise_std = 1):
+def traj_smooth(data,col = ['id','time','lon', 'lat'],proj = False,process_noise_std = 0.5, measurement_noise_std = 1, method = 'kalman', batch_size = 1000000):
     '''
     Smooth Trajectory Using Kalman Filter.
 
@@ -104,12 +97,18 @@ def traj_smooth(data,col = ['id','time','lon', 'lat'],proj = False,process_noise
         Standard deviation of the process noise
     measurement_noise_std: float
         Standard deviation of the measurement noise
+    method: str
+        'kalman' or 'rts'. 'kalman' is the forward filter, which only uses the past observations of each point. 'rts' adds the Rauch-Tung-Striebel backward pass, which also uses the later observations and does not lag on turns.
+    batch_size: int
+        Number of points smoothed at a time, which bounds the memory. The batches are made of whole trajectories.
 
     Returns
     -------
     data: DataFrame
-        Smoothed trajectory data
+        Smoothed trajectory data, sorted by ID and time
     '''
+    if method not in ['kalman', 'rts']:
+        raise ValueError('Method should be `kalman` or `rts`')
     id, time, lon, lat = col
     data = data.copy()
     data[time] = pd.to_datetime(data[time])
@@ -126,90 +125,34 @@ def traj_smooth(data,col = ['id','time','lon', 'lat'],proj = False,process_noise
     else:
         data['x'] = data[lon]
         data['y'] = data[lat]
-    # Smooth the trajectory for each ID
-    def Kalman_traj_smooth(data,process_noise_std, measurement_noise_std):
-        '''
-        Smoothing Trajectory Data Using a Kalman Filter
-
-        Parameters
-        ----
-        data: DataFrame
-            Trajectory data, including columns for time, longitude, and latitude.
-        process_noise_std: float or list
-            Standard deviation of the process noise. If it is a list, it is assumed to be the diagonal elements of the process noise covariance matrix.
-        measurement_noise_std: float or list
-            Standard deviation of the measurement noise. If it is a list, it is assumed to be the diagonal elements of the measurement noise covariance matrix.
-
-        Returns
-        ----
-        data: DataFrame
-            Smoothed trajectory data.
-        '''
-        # 拷贝数据，避免修改原始数据
-        data = data.copy()
-        # 轨迹数据转换为numpy数组
-        observations = data[['x', 'y']].values
-        timestamps = data[time]
-        # F-状态转移矩阵
-        transition_matrix = np.array([[1, 0, 1, 0],
-                                    [0, 1, 0, 1],
-                                    [0, 0, 1, 0],
-                                    [0, 0, 0, 1]])
-        # H-观测矩阵
-        observation_matrix = np.array([[1, 0, 0, 0],
-                                    [0, 1, 0, 0]])
-        # R-观测噪声协方差矩阵
-        # 如果measurement_noise_std是list，则认为是观测噪声协方差矩阵的对角线元素
-        if isinstance(measurement_noise_std, list):
-            observation_covariance = np.diag(measurement_noise_std)**2  # pragma: no cover
-        else:
-            observation_covariance = np.eye(2) * measurement_noise_std**2
-        # Q-过程噪声协方差矩阵
-        # 如果process_noise_std是list，则认为是过程噪声协方差矩阵的对角线元素
-        if isinstance(process_noise_std, list):
-            transition_covariance = np.diag(process_noise_std)**2   # pragma: no cover
-        else:
-            transition_covariance = np.eye(4) * process_noise_std**2    
-        # 初始状态
-        initial_state_mean = [observations[0, 0], observations[0, 1], 0, 0]
-        # 初始状态协方差矩阵
-        initial_state_covariance = np.eye(4) * 1
-        # 初始化卡尔曼滤波器
-        kf = KalmanFilter(
-            transition_matrices=transition_matrix,
-            observation_matrices=observation_matrix,
-            initial_state_mean=initial_state_mean,
-            initial_state_covariance=initial_state_covariance,
-            observation_covariance=observation_covariance,
-            transition_covariance=transition_covariance
-        )
-        # 使用卡尔曼滤波器进行平滑处理
-        # 先创建变量存储平滑后的状态
-        smoothed_states = np.zeros((len(observations), 4))
-        # 将初始状态存储到平滑后的状态中
-        smoothed_states[0, :] = initial_state_mean
-        # 从第二个状态开始，进行循环迭代
-        current_state = initial_state_mean
-        current_covariance = initial_state_covariance
-        for i in range(1, len(observations)):
-            # 计算时间间隔
-            dt = (timestamps.iloc[i] - timestamps.iloc[i - 1]).total_seconds()  
-            # 更新状态转移矩阵
-            kf.transition_matrices = np.array([[1, 0, dt, 0],
-                                            [0, 1, 0, dt],
-                                            [0, 0, 1, 0],
-                                            [0, 0, 0, 1]])
-            # 根据当前状态的预测情况与观测结果进行状态估计
-            current_state, current_covariance = kf.filter_update(
-                current_state, current_covariance, observations[i]
-            )
-            # 将平滑后的状态存储到变量中
-            smoothed_states[i, :] = current_state 
-        # 将平滑后的数据结果添加到原始数据中
-        data['x'] = smoothed_states[:, 0]
-        data['y'] = smoothed_states[:, 1]
-        return data
-    data = data.groupby(id).apply(lambda x:Kalman_traj_smooth(x,process_noise_std, measurement_noise_std))
+    # Smooth the trajectories of all IDs at once
+    group = data[id].values
+    newgroup = np.ones(len(data), dtype=bool)
+    newgroup[1:] = group[1:] != group[:-1]
+    starts = np.flatnonzero(newgroup)
+    lengths = np.diff(np.append(starts, len(data)))
+    # 相邻两点的时间间隔（秒）
+    timestamps = data[time].values
+    dt = np.zeros(len(data))
+    dt[1:] = (timestamps[1:] - timestamps[:-1]) / np.timedelta64(1, 's')
+    observations = data[['x', 'y']].values
+    states = np.zeros((len(data), 4))
+    ends = starts + lengths
+    i = 0
+    while i < len(starts):
+        # 每批包含若干条完整轨迹，点数不超过batch_size（至少一条轨迹）
+        j = max(np.searchsorted(ends, starts[i] + batch_size, side='right'),
+                i + 1)
+        batch_starts = starts[i:j]
+        batch_lengths = lengths[i:j]
+        batch = slice(batch_starts[0], ends[j - 1])
+        i = j
+        states[batch] = kalman_filter_cv(
+            observations[batch], dt[batch], batch_starts - batch_starts[0],
+            batch_lengths, process_noise_std, measurement_noise_std,
+            smooth=(method == 'rts'))
+    data['x'] = states[:, 0]
+    data['y'] = states[:, 1]
     if proj:
         data['geometry'] = gpd.points_from_xy(data['x'],data['y'])
         data.crs = epsg
@@ -223,55 +166,752 @@ def traj_smooth(data,col = ['id','time','lon', 'lat'],proj = False,process_noise
         data.drop(['x','y'],axis=1,inplace=True)
     return data
 
-def traj_mapmatch(traj,G,col=['lon','lat']):
+def kalman_filter_cv(observations, dt, starts, lengths,
+                     process_noise_std=0.5, measurement_noise_std=1,
+                     smooth=False):
+    '''
+    Constant velocity Kalman filter of many trajectories at once. The
+    state of each trajectory is [x, y, vx, vy], and the first state is the
+    first observation with zero velocity. In each step, the predict and
+    update of all the trajectories still running are computed together
+    on stacked arrays.
+
+    Parameters
+    ----------
+    observations: ndarray
+        (N, 2) observed coordinates, the points of each trajectory are
+        contiguous and in time order
+    dt: ndarray
+        Time interval (s) from the previous point of each point
+    starts: ndarray
+        Position of the first point of each trajectory
+    lengths: ndarray
+        Number of points of each trajectory
+    process_noise_std: float or list
+        Standard deviation of the process noise. If it is a list, it is the diagonal of the process noise covariance matrix.
+    measurement_noise_std: float or list
+        Standard deviation of the measurement noise. If it is a list, it is the diagonal of the measurement noise covariance matrix.
+    smooth: bool
+        Whether to run the Rauch-Tung-Striebel backward pass after the
+        filter, so that each state also uses the later observations
+
+    Returns
+    -------
+    states: ndarray
+        (N, 4) filtered states, or the smoothed states if smooth is True
+    '''
+    # R-观测噪声协方差矩阵，Q-过程噪声协方差矩阵
+    if isinstance(measurement_noise_std, list):
+        observation_covariance = np.diag(measurement_noise_std)**2  # pragma: no cover
+    else:
+        observation_covariance = np.eye(2) * measurement_noise_std**2
+    if isinstance(process_noise_std, list):
+        transition_covariance = np.diag(process_noise_std)**2   # pragma: no cover
+    else:
+        transition_covariance = np.eye(4) * process_noise_std**2
+    observations = np.asarray(observations, dtype=float)
+    states = np.zeros((len(observations), 4))
+    if len(observations) == 0:
+        return states
+    # 按轨迹长度降序排列，第k步仍在进行的轨迹即为前n条
+    order = np.argsort(-lengths, kind='stable')
+    starts = starts[order]
+    lengths = lengths[order]
+    # 初始状态为第一个观测点，速度为0，协方差为单位阵
+    mean = np.zeros((len(starts), 4))
+    mean[:, :2] = observations[starts]
+    covariance = np.tile(np.eye(4), (len(starts), 1, 1))
+    states[starts] = mean
+    if smooth:
+        # 后向平滑需要每一点的滤波协方差
+        covariances = np.zeros((len(observations), 4, 4))
+        covariances[starts] = covariance
+    for k in range(1, lengths[0]):
+        n = np.searchsorted(-lengths, -k, side='left')
+        rows = starts[:n] + k
+        mean = mean[:n]
+        covariance = covariance[:n]
+        # 预测：x = Fx, P = FPF' + Q
+        F = np.tile(np.eye(4), (n, 1, 1))
+        F[:, 0, 2] = dt[rows]
+        F[:, 1, 3] = dt[rows]
+        mean = np.einsum('nij,nj->ni', F, mean)
+        covariance = F @ covariance @ F.transpose(0, 2, 1) + \
+            transition_covariance
+        # 更新：K = PH'(HPH' + R)^-1
+        gain = covariance[:, :, :2] @ np.linalg.inv(
+            covariance[:, :2, :2] + observation_covariance)
+        mean = mean + np.einsum(
+            'nij,nj->ni', gain, observations[rows] - mean[:, :2])
+        covariance = covariance - gain @ covariance[:, :2, :]
+        states[rows] = mean
+        if smooth:
+            covariances[rows] = covariance
+    if smooth:
+        # RTS后向平滑：x_k = x_k + C(x_k+1 - Fx_k), C = PF'(FPF' + Q)^-1
+        for k in range(lengths[0] - 2, -1, -1):
+            n = np.searchsorted(-lengths, -(k + 1), side='left')
+            rows = starts[:n] + k
+            F = np.tile(np.eye(4), (n, 1, 1))
+            F[:, 0, 2] = dt[rows + 1]
+            F[:, 1, 3] = dt[rows + 1]
+            cross = covariances[rows] @ F.transpose(0, 2, 1)
+            predicted = np.einsum('nij,nj->ni', F, states[rows])
+            gain = cross @ np.linalg.inv(F @ cross + transition_covariance)
+            states[rows] += np.einsum(
+                'nij,nj->ni', gain, states[rows + 1] - predicted)
+    return states
+
+
+def traj_mapmatch(traj, G, col=['lon', 'lat'], maxdist=None):
     '''
     Nearest map matching: Find the nearest point on the road network for each trajectory point.
-    When conducting nearest neighbor matching, we need to find the closest road segment on the road network for each trajectory point, and match the trajectory point to that segment. In practice, we can first extract the nodes of the road segments to form a set of points (i.e., extracting each coordinate point from each LineString in the geometry column), then calculate the nearest distance between the trajectory point and this set of points, and finally match the trajectory point to the road segment where the nearest distance's node is located. This process effectively transforms the problem of matching points to lines into a problem of matching points to points.
+    The road network is projected to local planar coordinates (m) and indexed by an STRtree of the edge geometries (see `RoadNetworkIndex`). For each trajectory point, the tree returns the edge whose nearest segment is the closest to the point, and the point is snapped to its projection on that edge. All the trajectory points are queried, located and interpolated on the edges at once.
 
     Parameters
     -------
     traj : DataFrame
         The trajectory point data set to be matched.
-    G : networkx multidigraph
-        The road network used for matching, created by osmnx.
+    G : networkx multidigraph or RoadNetworkIndex
+        The road network used for matching, created by osmnx, or its index built by `RoadNetworkIndex` to match many batches of trajectories against the same network.
     col : list
         The name of the longitude and latitude columns in the trajectory point data set.
+    maxdist : number
+        Maximum distance (m) from the trajectory point to the edge. The points without any edge within maxdist are not matched, their longitude, latitude, `u`, `v`, `key` and `dist` are NaN. By default all the points are matched.
 
     Returns
     -------
-    traj_matched : DataFrame
-        The trajectory point data set after matching.
+    traj_matched : GeoDataFrame
+        The trajectory point data set after matching. The longitude and latitude are the matched points on the edges, `u`, `v` and `key` give the matched edge, and `dist` is the distance (m) from the original point. The geometry is the matched point, in EPSG:4326.
     '''
-    lon,lat = col
+    lon, lat = col
     traj_matched = traj.copy()
-    # 将轨迹点数据转换为GeoDataFrame
-    traj_matched['geometry'] = gpd.points_from_xy(traj_matched[lon], traj_matched[lat])
-    traj_matched = gpd.GeoDataFrame(traj_matched)
-    # 将路网转换为GeoDataFrame
-    gdf_nodes, gdf_edges = ox.graph_to_gdfs(G)  
-    gdf_edges = gdf_edges[['geometry']].reset_index() # 仅保留几何信息，并重置索引
-    # 近邻匹配
-    traj_matched = ckdnearest_line(traj_matched,gdf_edges)
-    #为每一个轨迹点找到最近点的几何信息
-    def get_nearest_point_on_line(r):
-        point = r['geometry_x']
-        line = r['geometry_y']
-        nearestpoint = line.interpolate(line.project(point))
-        return nearestpoint
-    traj_matched['geometry'] = traj_matched.apply(get_nearest_point_on_line,axis=1)
-    #计算轨迹点到最近点的距离（米）
-    traj_matched['dist'] = getdistance(
-        traj_matched['geometry_x'].x,
-        traj_matched['geometry_x'].y,
-        traj_matched['geometry'].x,
-        traj_matched['geometry'].y)
-    #提取经纬度信息
-    traj_matched[lon] = traj_matched['geometry'].x
-    traj_matched[lat] = traj_matched['geometry'].y
-    #删除无用的字段
-    traj_matched = traj_matched.drop(['index','geometry_x','geometry_y'],axis = 1)
+    network = G if isinstance(G, RoadNetworkIndex) else \
+        RoadNetworkIndex(G)
+    x, y = network.project(traj_matched[lon].values.astype(float),
+                              traj_matched[lat].values.astype(float))
+    points = shapely.points(np.stack([x, y], axis=1))
+    # 最近路段（线段级精确距离）
+    (point_index, edge_index), dist = network.tree.query_nearest(
+        points, max_distance=maxdist, return_distance=True,
+        all_matches=False)
+    edge = np.full(len(traj_matched), -1)
+    edge[point_index] = edge_index
+    matched = edge >= 0
+    # 投影到路段上的最近点
+    line = network.geometry[np.maximum(edge, 0)]
+    nearest = shapely.line_interpolate_point(
+        line, shapely.line_locate_point(line, points))
+    mx, my = network.unproject(shapely.get_x(nearest),
+                                  shapely.get_y(nearest))
+    traj_matched[lon] = np.where(matched, mx, np.nan)
+    traj_matched[lat] = np.where(matched, my, np.nan)
+    distance = np.full(len(traj_matched), np.nan)
+    distance[point_index] = dist
+    traj_matched['dist'] = distance
+    for c in ['u', 'v', 'key']:
+        values = getattr(network, c)[np.maximum(edge, 0)]
+        if not matched.all():
+            values = np.where(matched, values, np.nan)
+        traj_matched[c] = values
+    traj_matched = gpd.GeoDataFrame(
+        traj_matched, geometry=gpd.points_from_xy(
+            traj_matched[lon], traj_matched[lat]), crs='epsg:4326')
     return traj_matched
 
+
+def traj_mapmatch_hmm(traj, G, col=['id', 'time', 'lon', 'lat'], radius=50,
+                      sigma=10, beta=50, max_candidates=5,
+                      batch_size=50000):
+    '''
+    HMM map matching: Match the trajectory points to the road network considering the topology of the network.
+    The edges within the radius of each trajectory point are its candidates. The emission probability of a candidate decays with its distance to the point, and the transition probability between the candidates of two consecutive points decays with the difference between their shortest path distance on the network and the distance between the two points. The most likely sequence of candidates of each trajectory is decoded by the Viterbi algorithm, so that the points do not jump between parallel roads.
+    The throughput depends on the density of the network within the radius. On a dense city network (about 35 edge segments within 50 m of each point), it matched about 31k to 39k points per second on a single core with a prebuilt `RoadNetworkIndex`, most of the time being spent on the candidate search. A smaller radius or fewer candidates is faster.
+
+    Parameters
+    -------
+    traj : DataFrame
+        The trajectory point data set to be matched.
+    G : networkx multidigraph or RoadNetworkIndex
+        The road network used for matching, created by osmnx, or its index built by `RoadNetworkIndex` to match many batches of trajectories against the same network.
+    col : list
+        The name of the trajectory id, time, longitude and latitude columns in the trajectory point data set.
+    radius : number
+        Search radius (m) of the candidate edges
+    sigma : number
+        Standard deviation (m) of the GPS error, used in the emission probability
+    beta : number
+        Scale (m) of the exponential transition probability
+    max_candidates : int
+        Maximum number of candidate edges of each point
+    batch_size : int
+        Number of points matched at a time, which bounds the memory. The batches are made of whole trajectories.
+
+    Returns
+    -------
+    traj_matched : GeoDataFrame
+        The trajectory point data set after matching, sorted by id and time. The longitude and latitude are the matched points on the edges, `u`, `v` and `key` give the matched edge, and `dist` is the distance (m) from the original point. They are NaN for the points without candidates. The geometry is the matched point, in EPSG:4326.
+    '''
+    id, time, lon, lat = col
+    traj_matched = traj.copy()
+    traj_matched[time] = pd.to_datetime(traj_matched[time])
+    traj_matched = traj_matched.sort_values(by=[id, time])
+    network = G if isinstance(G, RoadNetworkIndex) else \
+        RoadNetworkIndex(G)
+    x, y = network.project(traj_matched[lon].values.astype(float),
+                              traj_matched[lat].values.astype(float))
+    group = traj_matched[id].values
+    newgroup = np.ones(len(traj_matched), dtype=bool)
+    newgroup[1:] = group[1:] != group[:-1]
+    starts = np.flatnonzero(newgroup)
+    lengths = np.diff(np.append(starts, len(traj_matched)))
+    edge = np.full(len(traj_matched), -1)
+    mx = np.full(len(traj_matched), np.nan)
+    my = np.full(len(traj_matched), np.nan)
+    dist = np.full(len(traj_matched), np.nan)
+    ends = starts + lengths
+    i = 0
+    while i < len(starts):
+        # 每批包含若干条完整轨迹，点数不超过batch_size（至少一条轨迹）
+        j = max(np.searchsorted(ends, starts[i] + batch_size, side='right'),
+                i + 1)
+        batch = slice(starts[i], ends[j - 1])
+        edge[batch], mx[batch], my[batch], dist[batch] = hmm_match_batch(
+            network, x[batch], y[batch], starts[i:j] - starts[i],
+            lengths[i:j], radius, sigma, beta, max_candidates)
+        i = j
+    # 匹配点坐标
+    matched = edge >= 0
+    mx, my = network.unproject(mx, my)
+    traj_matched['dist'] = dist
+    for c in ['u', 'v', 'key']:
+        values = getattr(network, c)[np.maximum(edge, 0)]
+        if not matched.all():
+            values = np.where(matched, values, np.nan)
+        traj_matched[c] = values
+    traj_matched[lon] = mx
+    traj_matched[lat] = my
+    traj_matched = gpd.GeoDataFrame(
+        traj_matched, geometry=gpd.points_from_xy(mx, my), crs='epsg:4326')
+    return traj_matched
+
+
+class RoadNetworkIndex:
+    '''
+    Index of a road network for map matching, built once from the network
+    and passed to `traj_mapmatch` and `traj_mapmatch_hmm` in place of the
+    network to match many batches of trajectories. The edges are projected
+    to local planar coordinates (m) around the center of the network. The
+    index holds the edge arrays, the vertices of each edge, the STRtree of
+    the edge geometries, a grid index of the edge segments and the sparse
+    graph of the network for the shortest paths.
+
+    The index is made of numeric arrays. It can be pickled, or saved to an
+    npz file that worker processes load with memory mapping.
+
+    Parameters
+    -------
+    G : networkx multidigraph
+        The road network, created by osmnx.
+    cellsize : number
+        Cell size (m) of the grid index of the edge segments
+
+    Attributes
+    -------
+    u, v, key : ndarray
+        The edges of the network
+    nodes : ndarray
+        The vertices of the network. `u_index` and `v_index` are the
+        positions of the vertices of each edge in it
+    length : ndarray
+        Length (m) of the edges
+    geometry : ndarray
+        Geometry of the edges in the planar coordinates
+    tree : STRtree
+        STRtree of the edge geometries
+    graph : csr_matrix
+        Sparse graph between the vertices, weighted by the edge length.
+        Only the shortest of the parallel edges is kept.
+
+    Examples
+    -------
+    >>> index = tbd.RoadNetworkIndex(G)
+    >>> index.save('network.npz')
+    >>> index = tbd.RoadNetworkIndex.load('network.npz', mmap_mode='r')
+    >>> traj_matched = tbd.traj_mapmatch(traj, index)
+    '''
+    _fields = ['center', 'u', 'v', 'key', 'nodes', 'u_index', 'v_index',
+               'length', 'coords', 'coords_index', 'graph_data',
+               'graph_indices', 'graph_indptr', 'segment_start',
+               'segment_vector', 'segment_inv2', 'segment_edge',
+               'segment_offset', 'planar_length', 'grid_origin',
+               'grid_cellsize', 'grid_shape', 'grid_cells', 'grid_first',
+               'grid_counts', 'grid_segment']
+
+    def __init__(self, G, cellsize=50):
+        from scipy.sparse import csr_matrix
+        gdf_edges = ox.graph_to_gdfs(G, nodes=False).reset_index()
+        # 以路网中心的等距投影把经纬度转换为平面坐标（米）
+        lon1, lat1, lon2, lat2 = gdf_edges.total_bounds
+        self.center = np.array([(lon1 + lon2) / 2, (lat1 + lat2) / 2])
+        coords, index = shapely.get_coordinates(
+            np.array(gdf_edges.geometry.values, dtype=object),
+            return_index=True)
+        self.coords = np.stack(self.project(coords[:, 0], coords[:, 1]),
+                               axis=1)
+        self.coords_index = index
+        self.u = gdf_edges['u'].values
+        self.v = gdf_edges['v'].values
+        self.key = gdf_edges['key'].values
+        self.nodes, node_index = np.unique(
+            np.concatenate([self.u, self.v]), return_inverse=True)
+        self.u_index = node_index[:len(gdf_edges)]
+        self.v_index = node_index[len(gdf_edges):]
+        self.length = gdf_edges['length'].values.astype(float)
+        # 平行边只保留最短的一条
+        order = np.lexsort([self.length, self.v_index, self.u_index])
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = (self.u_index[order][1:] != self.u_index[order][:-1]) | \
+            (self.v_index[order][1:] != self.v_index[order][:-1])
+        order = order[keep]
+        graph = csr_matrix(
+            (self.length[order], (self.u_index[order], self.v_index[order])),
+            shape=(len(self.nodes), len(self.nodes)))
+        self.graph_data = graph.data
+        self.graph_indices = graph.indices
+        self.graph_indptr = graph.indptr
+        # 路段拆分为线段，并按网格建立索引
+        same = index[1:] == index[:-1]
+        start = self.coords[:-1][same]
+        end = self.coords[1:][same]
+        self.segment_edge = index[:-1][same]
+        segment_length = np.hypot(*(end - start).T)
+        cumlength = np.cumsum(segment_length)
+        edge_first = np.searchsorted(self.segment_edge, self.segment_edge,
+                                     side='left')
+        self.segment_offset = cumlength - segment_length - \
+            (cumlength[edge_first] - segment_length[edge_first])
+        self.planar_length = np.bincount(
+            self.segment_edge, segment_length, minlength=len(gdf_edges))
+        vector = end - start
+        squared = (vector ** 2).sum(axis=1)
+        self.segment_start = np.ascontiguousarray(start.T)
+        self.segment_vector = np.ascontiguousarray(vector.T)
+        self.segment_inv2 = np.where(
+            squared > 0, 1 / np.where(squared > 0, squared, 1), 0)
+        self._build_grid(start, end, cellsize)
+
+    def _build_grid(self, start, end, cellsize):
+        # Register each segment in the grid cells its bounding box covers.
+        # The segments of each cell are contiguous in `grid_segment`.
+        origin = np.minimum(start, end).min(axis=0) if len(start) else \
+            np.zeros(2)
+        lower = np.floor((np.minimum(start, end) - origin) /
+                         cellsize).astype(np.int64)
+        upper = np.floor((np.maximum(start, end) - origin) /
+                         cellsize).astype(np.int64)
+        shape = (upper.max(axis=0) + 1) if len(start) else \
+            np.ones(2, np.int64)
+        span = upper - lower + 1
+        count = span[:, 0] * span[:, 1]
+        segment = np.repeat(np.arange(len(start)), count)
+        local = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count,
+                                                   count)
+        ci = lower[segment, 0] + local // span[segment, 1]
+        cj = lower[segment, 1] + local % span[segment, 1]
+        cell = ci * shape[1] + cj
+        order = np.argsort(cell, kind='stable')
+        self.grid_cells, self.grid_first, self.grid_counts = np.unique(
+            cell[order], return_index=True, return_counts=True)
+        self.grid_origin = origin
+        self.grid_cellsize = np.float64(cellsize)
+        self.grid_shape = shape
+        self.grid_segment = segment[order]
+
+    def project(self, lon, lat):
+        '''
+        Convert the longitude and latitude to the planar coordinates (m)
+        of the index
+        '''
+        lon0, lat0 = self.center
+        scale = 6371000 * np.pi / 180
+        return (lon - lon0) * scale * np.cos(np.radians(lat0)), \
+            (lat - lat0) * scale
+
+    def unproject(self, x, y):
+        '''
+        Convert the planar coordinates (m) of the index to the longitude
+        and latitude
+        '''
+        lon0, lat0 = self.center
+        scale = 6371000 * np.pi / 180
+        return x / (scale * np.cos(np.radians(lat0))) + lon0, \
+            y / scale + lat0
+
+    @property
+    def geometry(self):
+        if getattr(self, '_geometry', None) is None:
+            self._geometry = shapely.linestrings(
+                np.asarray(self.coords), indices=np.asarray(
+                    self.coords_index))
+        return self._geometry
+
+    @property
+    def tree(self):
+        if getattr(self, '_tree', None) is None:
+            self._tree = shapely.STRtree(self.geometry)
+        return self._tree
+
+    @property
+    def graph(self):
+        if getattr(self, '_graph', None) is None:
+            from scipy.sparse import csr_matrix
+            n = len(self.nodes)
+            self._graph = csr_matrix(
+                (self.graph_data, self.graph_indices, self.graph_indptr),
+                shape=(n, n))
+        return self._graph
+
+    def __getstate__(self):
+        # 几何、STRtree和稀疏图在使用时由数组重建
+        return {name: getattr(self, name) for name in self._fields}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def save(self, path):
+        '''
+        Save the index to an uncompressed npz file
+
+        Parameters
+        -------
+        path : str
+            Path of the npz file, `.npz` is appended if it has no such
+            suffix
+        '''
+        np.savez(npz_path(path), **self.__getstate__())
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        '''
+        Load the index from an npz file created by `save`
+
+        Parameters
+        -------
+        path : str
+            Path of the npz file, `.npz` is appended if it has no such
+            suffix, as in `save`
+        mmap_mode : str
+            If not None, memory-map the arrays with the given mode (see
+            `numpy.memmap`) instead of reading them, so that the processes
+            loading the same file share its memory
+
+        Returns
+        -------
+        index : RoadNetworkIndex
+            The road network index
+        '''
+        index = cls.__new__(cls)
+        path = npz_path(path)
+        if mmap_mode is None:
+            with np.load(path) as f:
+                index.__setstate__({name: f[name] for name in cls._fields})
+        else:
+            index.__setstate__(memmap_npz(path, mmap_mode))
+        return index
+
+    def query_segments(self, x, y, radius):
+        '''
+        The segments of the edges within the radius of each point
+
+        Parameters
+        -------
+        x, y : ndarray
+            Planar coordinates of the points
+        radius : number
+            Search radius (m)
+
+        Returns
+        -------
+        point : ndarray
+            Index of the point of each pair
+        segment : ndarray
+            Index of the segment of each pair
+        dist : ndarray
+            Distance from the point to the segment
+        t : ndarray
+            Position of the nearest point on the segment, from 0 to 1
+        '''
+        cellsize = self.grid_cellsize
+        shape = self.grid_shape
+        ring = int(np.ceil(radius / cellsize))
+        ci = np.floor((x - self.grid_origin[0]) / cellsize).astype(np.int64)
+        cj = np.floor((y - self.grid_origin[1]) / cellsize).astype(np.int64)
+        di, dj = np.meshgrid(np.arange(-ring, ring + 1),
+                             np.arange(-ring, ring + 1))
+        ci = ci[:, None] + di.ravel()
+        cj = cj[:, None] + dj.ravel()
+        valid = (ci >= 0) & (ci < shape[0]) & (cj >= 0) & (cj < shape[1])
+        point = np.broadcast_to(np.arange(len(x))[:, None], ci.shape)[valid]
+        cell = ci[valid] * shape[1] + cj[valid]
+        cells = self.grid_cells
+        pos = np.minimum(np.searchsorted(cells, cell),
+                         max(len(cells) - 1, 0))
+        found = cells[pos] == cell if len(cells) else \
+            np.zeros(len(cell), bool)
+        first = self.grid_first[pos][found]
+        count = self.grid_counts[pos][found]
+        point = point[found]
+        # 展开每个网格中的线段
+        offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count,
+                                                    count)
+        segment = self.grid_segment[np.repeat(first, count) + offset]
+        point = np.repeat(point, count)
+        # 点到线段的距离
+        ab_x = self.segment_vector[0][segment]
+        ab_y = self.segment_vector[1][segment]
+        ap_x = x[point] - self.segment_start[0][segment]
+        ap_y = y[point] - self.segment_start[1][segment]
+        t = np.clip((ap_x * ab_x + ap_y * ab_y) *
+                    self.segment_inv2[segment], 0, 1)
+        ap_x -= t * ab_x
+        ap_y -= t * ab_y
+        dist = np.hypot(ap_x, ap_y)
+        keep = np.flatnonzero(dist <= radius)
+        return point[keep], segment[keep], dist[keep], t[keep]
+
+
+def npz_path(path):
+    # numpy.savez appends .npz to the path without the suffix, load the
+    # same file
+    path = os.fspath(path)
+    return path if path.endswith('.npz') else path + '.npz'
+
+
+def memmap_npz(path, mmap_mode='r'):
+    '''
+    Memory-map the arrays of an uncompressed npz file, which `numpy.load`
+    reads into memory
+
+    Parameters
+    -------
+    path : str
+        Path of the npz file
+    mmap_mode : str
+        Mode of `numpy.memmap`
+
+    Returns
+    -------
+    arrays : dict
+        The arrays of the npz file
+    '''
+    import zipfile
+    import struct
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as fp:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('Compressed npz file cannot be '
+                                 'memory-mapped')
+            # 跳过zip的本地文件头，读取npy文件头
+            fp.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', fp.read(4))
+            fp.seek(name_length + extra_length, 1)
+            version = np.lib.format.read_magic(fp)
+            if version == (1, 0):
+                shape, fortran, dtype = \
+                    np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, fortran, dtype = \
+                    np.lib.format.read_array_header_2_0(fp)
+            name = info.filename[:-4] if info.filename.endswith('.npy') \
+                else info.filename
+            if dtype.hasobject:
+                raise ValueError('Object arrays cannot be memory-mapped')
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    path, dtype=dtype, mode=mmap_mode, offset=fp.tell(),
+                    shape=shape, order='F' if fortran else 'C')
+    return arrays
+
+
+def shortest_path_table(graph, sources, limit):
+    '''
+    The shortest path distances from the sources to all the nodes within
+    the limit of each source, as a sorted table of source*n+target keys
+
+    Parameters
+    -------
+    graph : csr_matrix
+        Sparse graph of the road network
+    sources : ndarray
+        Index of the source nodes, unique
+    limit : ndarray
+        Maximum distance of the shortest paths from each source
+
+    Returns
+    -------
+    keys : ndarray
+        Sorted keys of the source and target
+    dist : ndarray
+        Shortest path distance of each key
+    '''
+    from scipy.sparse.csgraph import dijkstra
+    n = graph.shape[0]
+    keys = []
+    dist = []
+    # 按距离上限排序后分块，每块取块内最大的上限
+    order = np.argsort(limit, kind='stable')
+    sources = sources[order]
+    limit = limit[order]
+    for i in range(0, len(sources), 256):
+        chunk = sources[i:i + 256]
+        d = dijkstra(graph, directed=True, indices=chunk,
+                     limit=limit[i:i + 256].max())
+        row, target = np.nonzero(np.isfinite(d))
+        keys.append(chunk[row] * n + target)
+        dist.append(d[row, target])
+    keys = np.concatenate(keys) if keys else np.array([], dtype=np.int64)
+    dist = np.concatenate(dist) if dist else np.array([])
+    order = np.argsort(keys)
+    return keys[order], dist[order]
+
+
+def hmm_match_batch(network, x, y, starts, lengths, radius, sigma, beta,
+                    max_candidates):
+    # Candidates, emission and transition probabilities and the Viterbi
+    # decoding of a batch of trajectories. Returns the matched edge (-1 if
+    # no candidate), the matched point and its distance of each point.
+    N = len(x)
+    K = max_candidates
+    # 候选路段：半径范围内最近的K条路段，每条路段取其最近的线段
+    point_index, segment, d, t = network.query_segments(x, y, radius)
+    edge_index = network.segment_edge[segment]
+    # 距离归一化到[0, 1)后与整数键相加，一次排序即可按键和距离排列
+    scaled = d / (radius * (1 + 1e-9) + 1e-12)
+    order = np.argsort(
+        (point_index * len(network.length) + edge_index) + scaled)
+    point_index, edge_index, segment, d, t, scaled = point_index[order], \
+        edge_index[order], segment[order], d[order], t[order], scaled[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (point_index[1:] != point_index[:-1]) | \
+        (edge_index[1:] != edge_index[:-1])
+    point_index, edge_index, segment, d, t, scaled = point_index[first], \
+        edge_index[first], segment[first], d[first], t[first], scaled[first]
+    order = np.argsort(point_index + scaled)
+    point_index, edge_index, segment, d, t = point_index[order], \
+        edge_index[order], segment[order], d[order], t[order]
+    rank = np.arange(len(point_index)) - np.searchsorted(
+        point_index, point_index, side='left')
+    keep = rank < K
+    point_index, edge_index, segment, d, t, rank = point_index[keep], \
+        edge_index[keep], segment[keep], d[keep], t[keep], rank[keep]
+    start_x = network.segment_start[0][segment]
+    start_y = network.segment_start[1][segment]
+    vector_x = network.segment_vector[0][segment]
+    vector_y = network.segment_vector[1][segment]
+    cand_edge = np.full((N, K), -1)
+    cand_edge[point_index, rank] = edge_index
+    cand_offset = np.zeros((N, K))
+    cand_offset[point_index, rank] = (
+        network.segment_offset[segment] +
+        t * np.hypot(vector_x, vector_y)) / np.maximum(
+        network.planar_length[edge_index], 1e-12)
+    cand_x = np.full((N, K), np.nan)
+    cand_y = np.full((N, K), np.nan)
+    cand_x[point_index, rank] = start_x + t * vector_x
+    cand_y[point_index, rank] = start_y + t * vector_y
+    cand_dist = np.full((N, K), np.nan)
+    cand_dist[point_index, rank] = d
+    emission = np.full((N, K), -np.inf)
+    emission[point_index, rank] = -0.5 * (d / sigma) ** 2
+    valid = cand_edge >= 0
+    edge_safe = np.where(valid, cand_edge, 0)
+    # 相邻两点之间候选路段的路网距离
+    step = np.ones(N, dtype=bool)
+    step[starts + lengths - 1] = False
+    prev = np.flatnonzero(step)
+    gc = np.hypot(x[prev + 1] - x[prev], y[prev + 1] - y[prev])
+    length = network.length
+    ea = edge_safe[prev][:, :, None]
+    eb = edge_safe[prev + 1][:, None, :]
+    oa = cand_offset[prev][:, :, None] * length[ea]
+    ob = cand_offset[prev + 1][:, None, :] * length[eb]
+    source = network.v_index[ea]
+    target = network.u_index[eb]
+    # 每对相邻点的最短路上限，超过时转移概率可忽略。每个起点的上限取其所在
+    # 各对的最大值，一段长间隔只放宽它自己的起点
+    step_limit = 2 * radius + 20 * beta + gc
+    limit = np.broadcast_to(step_limit[:, None],
+                            valid[prev].shape)[valid[prev]]
+    sources, inverse = np.unique(source[:, :, 0][valid[prev]],
+                                 return_inverse=True)
+    source_limit = np.zeros(len(sources))
+    np.maximum.at(source_limit, inverse, limit)
+    keys, dist = shortest_path_table(network.graph, sources, source_limit)
+    n = network.graph.shape[0]
+    key = source * n + target
+    pos = np.minimum(np.searchsorted(keys, key), max(len(keys) - 1, 0))
+    found = (keys[pos] == key) if len(keys) > 0 else np.zeros(
+        key.shape, dtype=bool)
+    if len(keys) > 0:
+        # 只采用本对上限内的最短路，结果与分批方式无关
+        found &= dist[pos] <= step_limit[:, None, None]
+    path = np.where(found, dist[pos] if len(keys) > 0 else 0, np.inf)
+    route = np.where((ea == eb) & (ob >= oa), ob - oa,
+                     length[ea] - oa + path + ob)
+    transition = -np.abs(route - gc[:, None, None]) / beta
+    transition[~(valid[prev][:, :, None] & valid[prev + 1][:, None, :])] = \
+        -np.inf
+    transition = np.where(np.isfinite(route), transition, -np.inf)
+    # 转移概率数组按前一点的位置索引
+    trans = np.full((N, K, K), -np.inf)
+    trans[prev] = transition
+    # Viterbi：按轨迹长度降序排列，第k步仍在进行的轨迹即为前n条
+    order = np.argsort(-lengths, kind='stable')
+    starts = starts[order]
+    lengths = lengths[order]
+    score = emission.copy()
+    back = np.zeros((N, K), dtype=np.int64)
+    restart = np.zeros(N, dtype=bool)
+    current = emission[starts]
+    for k in range(1, lengths[0] if len(lengths) > 0 else 0):
+        m = np.searchsorted(-lengths, -k, side='left')
+        rows = starts[:m] + k
+        total = current[:m, :, None] + trans[rows - 1]
+        back[rows] = total.argmax(axis=1)
+        best = total.max(axis=1)
+        # 无法从上一点到达时轨迹断开，从该点重新开始
+        broken = ~np.isfinite(best).any(axis=1)
+        restart[rows] = broken
+        current = np.where(broken[:, None], emission[rows],
+                           best + emission[rows])
+        score[rows] = current
+
+    def best_state(s):
+        return np.where(np.isfinite(s).any(axis=1), s.argmax(axis=1), -1)
+    state_index = np.full(N, -1)
+    state = np.full(len(starts), -1)
+    for k in range(lengths[0] - 1 if len(lengths) > 0 else -1, -1, -1):
+        m = np.searchsorted(-lengths, -k, side='left')
+        m_next = np.searchsorted(-lengths, -(k + 1), side='left')
+        rows = starts[:m] + k
+        state[m_next:m] = best_state(score[rows[m_next:m]])
+        state_index[rows] = state[:m]
+        if k > 0:
+            pointer = back[rows, np.maximum(state[:m], 0)]
+            state[:m] = np.where(restart[rows] | (state[:m] < 0),
+                                 best_state(score[rows - 1]), pointer)
+    matched = state_index >= 0
+    rows = np.arange(N)
+    safe = np.maximum(state_index, 0)
+    edge = np.where(matched, cand_edge[rows, safe], -1)
+    return edge, cand_x[rows, safe], cand_y[rows, safe], \
+        cand_dist[rows, safe]
+
+
 def traj_clean_redundant(data, col=['VehicleNum', 'Time', 'Lng', 'Lat']):
     '''
     Delete the data with the same information as the data before and
@@ -341,25 +981,19 @@ def traj_clean_drift(data, col=['VehicleNum', 'Time', 'Lng', 'Lat'],
     data1 = data1.sort_values(by=[VehicleNum, Time])
 
     #计算前后点距离、时间差、速度
-    for i in [VehicleNum, Lng, Lat, Time+'_dt']:
+    for i in [VehicleNum, Time+'_dt']:
         data1[i+'_pre'] = data1[i].shift()
         data1[i+'_next'] = data1[i].shift(-1)
 
-    data1['dis_pre'] = getdistance(
-        data1[Lng],
-        data1[Lat],
-        data1[Lng+'_pre'],
-        data1[Lat+'_pre'])
-    data1['dis_next'] = getdistance(
-        data1[Lng],
-        data1[Lat],
-        data1[Lng+'_next'],
-        data1[Lat+'_next'])
-    data1['dis_prenext'] = getdistance(
-        data1[Lng+'_pre'],
-        data1[Lat+'_pre'],
-        data1[Lng+'_next'],
-        data1[Lat+'_next'])
+    lng_values = data1[Lng].values.astype(float)
+    lat_values = data1[Lat].values.astype(float)
+    dis_next = consecutive_distance(lng_values, lat_values)
+    data1['dis_next'] = dis_next
+    data1['dis_pre'] = np.concatenate([[np.nan], dis_next[:-1]])
+    dis_prenext = np.full(len(data1), np.nan)
+    dis_prenext[1:-1] = getdistance(
+        lng_values[:-2], lat_values[:-2], lng_values[2:], lat_values[2:])
+    data1['dis_prenext'] = dis_prenext
     
     #计算前后点时间差
     data1['timegap_pre'] = data1[Time+'_dt'] - data1[Time+'_dt_pre']
@@ -39,6 +39,7 @@ from .grids import (
     GPS_to_grid,
     grid_to_polygon,
     grid_to_centre,
+    packed_to_grid
 )
 from .odprocess import (
     odagg_grid
@@ -426,11 +427,12 @@ def visualization_data(data, col=['lon', 'lat'], accuracy=500, height=500,
                 0.05), data[lon].quantile(0.95)
             zoom = 8.5-np.log(lon_max-lon_min)/np.log(2)
         params = area_to_params(bounds, accuracy=accuracy)
-        data['LONCOL'], data['LATCOL'] = GPS_to_grid(
-            data[lon], data[lat], params)
+        data = pd.DataFrame({'grid': GPS_to_grid(
+            data[lon], data[lat], params, packed=True)})
         data[count] = 1
-        data = data.groupby(['LONCOL', 'LATCOL'])[
-            'count'].sum().reset_index().reset_index()
+        data = data.groupby('grid')['count'].sum().reset_index()
+        data['LONCOL'], data['LATCOL'] = packed_to_grid(data['grid'], params)
+        data = data[['LONCOL', 'LATCOL', 'count']].reset_index()
         data['geometry'] = grid_to_polygon(
             [data['LONCOL'], data['LATCOL']], params)
         data[lon], data[lat] = grid_to_centre(
@@ -454,9 +456,12 @@ def visualization_data(data, col=['lon', 'lat'], accuracy=500, height=500,
                 0.05), data[lon].quantile(0.95)
             zoom = 8.5-np.log(lon_max-lon_min)/np.log(2)
         params = area_to_params(bounds, accuracy=accuracy)
-        data['LONCOL'], data['LATCOL'] = GPS_to_grid(
-            data[lon], data[lat], params)
-        data = data.groupby(['LONCOL', 'LATCOL'])[count].sum().reset_index()
+        data = pd.DataFrame({'grid': GPS_to_grid(
+            data[lon], data[lat], params, packed=True),
+            count: data[count].values})
+        data = data.groupby('grid')[count].sum().reset_index()
+        data['LONCOL'], data['LATCOL'] = packed_to_grid(data['grid'], params)
+        data = data[['LONCOL', 'LATCOL', count]]
         data['geometry'] = grid_to_polygon(
             [data['LONCOL'], data['LATCOL']], params)
         data[lon], data[lat] = grid_to_centre(